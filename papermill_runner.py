@@ -4,13 +4,18 @@
 
 """Programmatic execution of notebooks."""
 
-
+import hashlib
+import json
 import os
 import shlex
 import subprocess
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
-from typing import Dict, List
+from itertools import product
+from multiprocessing import cpu_count
+from typing import Dict, List, Tuple
 
+import pandas as pd
 import papermill as pm
 
 # pylint: disable=invalid-name,dangerous-default-value, redefined-outer-name
@@ -55,6 +60,9 @@ zero_dict = dict(
     ],
 )
 
+# Notebooks that must be run before each notebook
+nb_dependencies = {zero_dict_nb_name: []}
+
 
 def run_cmd(cmd: str) -> None:
     """."""
@@ -72,13 +80,15 @@ def run_cmd(cmd: str) -> None:
 
 
 def papermill_run_notebook(
-    nb_dict: Dict, output_notebook_dir: str = "executed_notebooks"
+    nb_dict: Dict,
+    output_notebook_dir: str = "executed_notebooks",
+    output_nb_suffix: str = "",
 ) -> None:
     """Execute notebook with papermill"""
     for notebook, nb_params in nb_dict.items():
         now = datetime.now().strftime("%Y%m%d-%H%M%S")
         output_nb = os.path.basename(notebook).replace(
-            ".ipynb", f"-{now}.ipynb"
+            ".ipynb", f"-{now}{output_nb_suffix}.ipynb"
         )
         print(
             f"\nInput notebook path: {notebook}",
@@ -94,6 +104,110 @@ def papermill_run_notebook(
         )
 
 
+def expand_param_grid(nb_params: Dict, param_grid: Dict[str, List]) -> List:
+    """Get notebook parameters for every combination of grid values."""
+    grid_names = list(param_grid)
+    return [
+        {**nb_params, **dict(zip(grid_names, grid_values))}
+        for grid_values in product(*param_grid.values())
+    ]
+
+
+def papermill_run_sweep(
+    notebook: str,
+    nb_params: Dict,
+    param_grid: Dict[str, List],
+    scores_filepath: str,
+    output_notebook_dir: str = "executed_notebooks",
+    n_jobs: int = cpu_count(),
+    force: bool = False,
+) -> pd.DataFrame:
+    """Execute notebook for every combination of parameters in a grid.
+    Parameters
+    ----------
+    notebook : str
+        path to notebook to be executed
+    nb_params : Dict
+        parameters common to all executions of the notebook
+    param_grid : Dict
+        mapping of parameter name to list of values to be swept over; values
+        override those in nb_params
+    scores_filepath : str
+        path to .parquet file to which scores from all executions are written
+    output_notebook_dir : str
+        directory to which executed notebooks are written
+    n_jobs : int
+        maximum number of notebooks to execute at the same time
+    force : bool
+        whether to execute runs whose notebook contents and parameters are
+        unchanged since they were last executed
+    Returns
+    -------
+    df_scores : pd.DataFrame
+        scores from all successful executions, with one column per swept
+        parameter (non-scalar parameter values are stored as str)
+    Notes
+    -----
+    1. Each execution is passed a scores_filepath parameter and the notebook
+       is expected to write its scores table to this .parquet file. Runs
+       that raise an error, or do not write this file, are counted as
+       failed. Each execution runs in a separate process, with its own
+       kernel.
+    2. The sweep is run as a single task of run_notebook_dag(), so runs are
+       skipped if they are unchanged (see run_notebook_dag()). Sweeps can
+       also be run together with other notebooks, by passing them as tasks
+       to run_notebook_dag().
+    Usage
+    -----
+    > nb_name = "a.ipynb"
+    > df_scores = papermill_run_sweep(
+          os.path.join(PROJ_ROOT_DIR, nb_name),
+          {"a": 1},
+          {"b": [1, 2, 3]},
+          os.path.join(output_notebook_dir, "scores.parquet"),
+      )
+    """
+    task = os.path.basename(notebook).replace(".ipynb", "_sweep")
+    statuses = run_notebook_dag(
+        {task: (notebook, nb_params, param_grid, scores_filepath)},
+        {},
+        output_notebook_dir,
+        n_jobs,
+        force,
+    )
+    if statuses[task] == "failed":
+        raise RuntimeError(f"All sweep runs of {notebook} failed")
+    return pd.read_parquet(scores_filepath)
+
+
+def write_sweep_scores(
+    runs: List[Dict], param_grid: Dict[str, List], scores_filepath: str
+) -> None:
+    """Write scores of all successful runs of a sweep to one .parquet file."""
+    dfs_scores = []
+    for k, run in enumerate(runs):
+        if run["status"] == "failed":
+            continue
+        run_scores_filepath = run["params"]["scores_filepath"]
+        if not os.path.exists(run_scores_filepath):
+            print(
+                f"Failed sweep run {k:03d}\nNo scores written to "
+                f"{run_scores_filepath}"
+            )
+            continue
+        df_run_scores = pd.read_parquet(run_scores_filepath)
+        for name in param_grid:
+            value = run["params"][name]
+            df_run_scores[name] = (
+                value if isinstance(value, (str, int, float)) else str(value)
+            )
+        dfs_scores.append(df_run_scores.assign(run=k))
+    if not dfs_scores:
+        raise RuntimeError(f"All sweep runs failed ({scores_filepath})")
+    df_scores = pd.concat(dfs_scores, ignore_index=True)
+    df_scores.to_parquet(scores_filepath, index=False)
+
+
 def run_notebooks(
     notebook_list: List, output_notebook_dir: str = "executed_notebooks"
 ) -> None:
@@ -120,14 +234,308 @@ def run_notebooks(
         )
 
 
+def get_run_hash(notebook: str, nb_params: Dict, upstream_hashes: List) -> str:
+    """Get hash of notebook contents, its parameters and upstream runs."""
+    sha = hashlib.sha256()
+    with open(notebook, "rb") as f:
+        sha.update(f.read())
+    sha.update(json.dumps(nb_params, sort_keys=True, default=str).encode())
+    for upstream_hash in upstream_hashes:
+        sha.update(upstream_hash.encode())
+    return sha.hexdigest()
+
+
+def read_run_hashes(hashes_filepath: str) -> Dict[str, str]:
+    """Read hashes of completed notebook runs, if any have been stored."""
+    if not os.path.exists(hashes_filepath):
+        return {}
+    with open(hashes_filepath) as f:
+        return json.load(f)
+
+
+def get_upstream_state(upstream_statuses: List) -> str:
+    """Get state of a task's upstream tasks, from their statuses.
+    Returns
+    -------
+    upstream_state : str
+        "failed" if any upstream task failed (or its upstream failed),
+        "waiting" if any have not completed yet, "done" if any were executed
+        and "unchanged" if all were skipped (or there are none)
+    """
+    if any(s in ("failed", "upstream_failed") for s in upstream_statuses):
+        return "failed"
+    if not all(s in ("done", "unchanged") for s in upstream_statuses):
+        return "waiting"
+    if "done" in upstream_statuses:
+        return "done"
+    return "unchanged"
+
+
+def get_task_runs(
+    task: str,
+    task_spec: Tuple,
+    upstream_hashes: List,
+    output_notebook_dir: str,
+) -> List[Dict]:
+    """Get notebook runs of a task, either a notebook or a sweep.
+    Parameters
+    ----------
+    task_spec : Tuple
+        (notebook path, notebook parameters) for a notebook, or (notebook
+        path, notebook parameters, parameter grid, scores filepath) for a
+        sweep (see papermill_run_sweep())
+    Returns
+    -------
+    runs : List
+        one dict per run, with its name (the task name for a notebook, or
+        <task>/run<k> for run k of a sweep), task, notebook, parameters,
+        output notebook suffix and hash
+    """
+    notebook, nb_params = task_spec[:2]
+    if len(task_spec) == 2:
+        runs = [dict(name=task, params=nb_params, suffix="")]
+    else:
+        # Scores of each run are written to a directory per task, so runs of
+        # sweeps of the same notebook do not overwrite each other's scores
+        runs_scores_dir = os.path.join(output_notebook_dir, f"{task}_scores")
+        os.makedirs(runs_scores_dir, exist_ok=True)
+        runs = [
+            dict(
+                name=f"{task}/run{k:03d}",
+                params=dict(
+                    run_params,
+                    scores_filepath=os.path.join(
+                        runs_scores_dir, f"run{k:03d}.parquet"
+                    ),
+                ),
+                suffix=f"-{task}-run{k:03d}",
+            )
+            for k, run_params in enumerate(
+                expand_param_grid(nb_params, task_spec[2])
+            )
+        ]
+    for run in runs:
+        run["task"] = task
+        run["notebook"] = notebook
+        run["hash"] = get_run_hash(notebook, run["params"], upstream_hashes)
+    return runs
+
+
+def is_run_unchanged(run: Dict, stored_hashes: Dict[str, str]) -> bool:
+    """Get whether a run was completed with the same hash (and scores)."""
+    scores_filepath = run["params"].get("scores_filepath")
+    return stored_hashes.get(run["name"]) == run["hash"] and (
+        scores_filepath is None or os.path.exists(scores_filepath)
+    )
+
+
+def get_task_status(task_spec: Tuple, runs: List[Dict]) -> str:
+    """Get status of a task once all its runs are completed (or skipped).
+    A sweep is unchanged if all its runs are unchanged and its scores file
+    exists, and otherwise done if the scores of at least one run were
+    written to its scores file.
+    """
+    if len(task_spec) == 2:
+        return runs[0]["status"]
+    if all(r["status"] == "unchanged" for r in runs) and os.path.exists(
+        task_spec[3]
+    ):
+        return "unchanged"
+    try:
+        write_sweep_scores(runs, task_spec[2], task_spec[3])
+    except Exception as e:
+        print(f"Failed sweep: {task_spec[0]}\n{e}")
+        return "failed"
+    return "done"
+
+
+def get_task_hash(runs: List[Dict]) -> str:
+    """Get hash of a task, from the hashes of its runs."""
+    if len(runs) == 1:
+        return runs[0]["hash"]
+    return hashlib.sha256(
+        "".join(r["hash"] for r in runs).encode()
+    ).hexdigest()
+
+
+def submit_task_runs(
+    executor: ProcessPoolExecutor,
+    runs: List[Dict],
+    stored_hashes: Dict[str, str],
+    output_notebook_dir: str,
+    skip_unchanged: bool,
+) -> Dict:
+    """Submit runs of a task to executor, skipping unchanged runs if wanted.
+    Returns mapping of future to run, for submitted runs.
+    """
+    futures = {}
+    for run in runs:
+        if skip_unchanged and is_run_unchanged(run, stored_hashes):
+            print(f"Skipping unchanged notebook run: {run['name']}")
+            run["status"] = "unchanged"
+            continue
+        # Scores left by an earlier run must not be taken for this run's
+        scores_filepath = run["params"].get("scores_filepath")
+        if scores_filepath and os.path.exists(scores_filepath):
+            os.remove(scores_filepath)
+        future = executor.submit(
+            papermill_run_notebook,
+            {run["notebook"]: run["params"]},
+            output_notebook_dir,
+            run["suffix"],
+        )
+        futures[future] = run
+    return futures
+
+
+def record_run_result(
+    future, run: Dict, stored_hashes: Dict[str, str], hashes_filepath: str
+) -> None:
+    """Set status of a completed run, and store its hash if it succeeded."""
+    if future.exception() is None:
+        run["status"] = "done"
+        stored_hashes[run["name"]] = run["hash"]
+        with open(hashes_filepath, "w") as f:
+            json.dump(stored_hashes, f, indent=4)
+    else:
+        print(f"Failed notebook run: {run['name']}\n{future.exception()}")
+        run["status"] = "failed"
+        stored_hashes.pop(run["name"], None)
+
+
+def run_notebook_dag(
+    tasks: Dict[str, Tuple],
+    dependencies: Dict[str, List],
+    output_notebook_dir: str = "executed_notebooks",
+    n_jobs: int = cpu_count(),
+    force: bool = False,
+) -> Dict[str, str]:
+    """Execute notebooks and sweeps in parallel, in order of dependencies.
+    Parameters
+    ----------
+    tasks : Dict
+        mapping of task name to (notebook path, notebook parameters) for a
+        notebook, or to (notebook path, notebook parameters, parameter grid,
+        scores filepath) for a sweep over a grid (see papermill_run_sweep())
+    dependencies : Dict
+        mapping of task name to list of names of tasks that must be
+        completed before it is run
+    output_notebook_dir : str
+        directory to which executed notebooks are written
+    n_jobs : int
+        maximum number of notebooks to execute at the same time, for all
+        tasks
+    force : bool
+        whether to execute notebooks whose contents, parameters and upstream
+        notebooks are unchanged since they were last executed
+    Returns
+    -------
+    statuses : Dict
+        mapping of task name to one of "done", "unchanged", "failed" or
+        "upstream_failed"
+    Notes
+    -----
+    1. Hashes of completed runs (of notebooks, and of each run of a sweep)
+       are stored in <output_notebook_dir>/.run_hashes.json. A run is
+       skipped if its hash matches the stored hash and none of its task's
+       upstream tasks were executed in this call. Since the hash of a run
+       includes the hashes of its upstream tasks, changing a notebook
+       re-runs all downstream notebooks, and re-running a notebook (eg.
+       after it failed) re-runs all downstream notebooks.
+    2. All runs of all tasks share one pool of processes, so the runs of a
+       sweep are executed alongside other notebooks. Each notebook is
+       executed in a separate process (with its own kernel).
+    Usage
+    -----
+    > tasks = {
+          "0_get_data.ipynb": ("/path/to/0_get_data.ipynb", zero_dict),
+          "1_naive.ipynb": ("/path/to/1_naive.ipynb", one_dict),
+          "1_naive_sweep": (
+              "/path/to/1_naive.ipynb",
+              one_dict,
+              {"naive_cutoffs": [[c] for c in one_dict["naive_cutoffs"]]},
+              "/path/to/scores.parquet",
+          ),
+      }
+    > dependencies = {
+          "1_naive.ipynb": ["0_get_data.ipynb"],
+          "1_naive_sweep": ["0_get_data.ipynb"],
+      }
+    > run_notebook_dag(tasks, dependencies, n_jobs=2)
+    """
+    hashes_filepath = os.path.join(output_notebook_dir, ".run_hashes.json")
+    stored_hashes = read_run_hashes(hashes_filepath)
+
+    statuses = {}
+    task_hashes = {}
+    task_runs = {}
+    pending = dict(tasks)
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        while pending or running:
+            num_pending = len(pending)
+            for task in list(pending):
+                # dependencies that are not being run are assumed complete
+                upstream = [
+                    u for u in dependencies.get(task, []) if u in tasks
+                ]
+                upstream_state = get_upstream_state(
+                    [statuses.get(u) for u in upstream]
+                )
+                if upstream_state == "failed":
+                    statuses[task] = "upstream_failed"
+                    del pending[task]
+                    continue
+                if upstream_state == "waiting":
+                    continue
+                runs = get_task_runs(
+                    task,
+                    pending.pop(task),
+                    [task_hashes[u] for u in upstream],
+                    output_notebook_dir,
+                )
+                task_runs[task] = runs
+                task_hashes[task] = get_task_hash(runs)
+                futures = submit_task_runs(
+                    executor,
+                    runs,
+                    stored_hashes,
+                    output_notebook_dir,
+                    not force and upstream_state == "unchanged",
+                )
+                running.update(futures)
+                if not futures:
+                    statuses[task] = get_task_status(tasks[task], runs)
+            if not running:
+                if pending and len(pending) == num_pending:
+                    raise ValueError(
+                        f"Circular dependencies between tasks: {list(pending)}"
+                    )
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                run = running.pop(future)
+                record_run_result(future, run, stored_hashes, hashes_filepath)
+                runs = task_runs[run["task"]]
+                if all("status" in r for r in runs):
+                    statuses[run["task"]] = get_task_status(
+                        tasks[run["task"]], runs
+                    )
+    return statuses
+
+
 if __name__ == "__main__":
     PROJ_ROOT_DIR = os.getcwd()
     nb_dict_list = [zero_dict]
     nb_name_list = [zero_dict_nb_name]
-    notebook_list = [
-        {os.path.join(PROJ_ROOT_DIR, nb_name): nb_dict}
+    tasks = {
+        nb_name: (os.path.join(PROJ_ROOT_DIR, nb_name), nb_dict)
         for nb_dict, nb_name in zip(nb_dict_list, nb_name_list)
-    ]
-    run_notebooks(
-        notebook_list=notebook_list, output_notebook_dir=output_notebook_dir
+    }
+    statuses = run_notebook_dag(
+        tasks, nb_dependencies, output_notebook_dir=output_notebook_dir
     )
+    print(json.dumps(statuses, indent=4))
+    if any(s in ("failed", "upstream_failed") for s in statuses.values()):
+        raise SystemExit(1)
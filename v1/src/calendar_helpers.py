@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import calendar
+import os
+
+import holidays
+import numpy as np
+import pandas as pd
+
+# Columns of the (country x date) calendar table, apart from country, date
+CALENDAR_COLS = [
+    "is_holiday",
+    "holiday_name",
+    "is_bridge_day",
+    "weekday_int",
+    "is_weekend",
+    "month",
+    "season",
+]
+
+
+def get_country_holiday_table(country, start_year, end_year, cache_dir=None):
+    """
+    Get holidays and bridge days for every date in a range of years
+
+    Parameters
+    ----------
+    country : str
+        country code, eg. DE or GB_GBN (the part after _ is ignored)
+    start_year : int
+        first year
+    end_year : int
+        last year (inclusive)
+    cache_dir : str
+        directory in which the table is cached (as a .parquet file), so the
+        holidays package is only called once per country and range of years
+    Returns
+    -------
+    df : pd.DataFrame
+        one row per date, with columns date, is_holiday, holiday_name (empty
+        if not a holiday) and is_bridge_day (a working day between two days
+        that are holidays or weekends)
+    """
+    if cache_dir:
+        cache_filepath = os.path.join(
+            cache_dir, f"holidays_{country}_{start_year}_{end_year}.parquet"
+        )
+        if os.path.exists(cache_filepath):
+            return pd.read_parquet(cache_filepath)
+
+    dates = pd.date_range(f"{start_year}-01-01", f"{end_year}-12-31", freq="D")
+    country_holidays = holidays.country_holidays(
+        country.split("_")[0], years=range(start_year, end_year + 1)
+    )
+    holiday_names = pd.Series(
+        [country_holidays.get(d, "") for d in dates.date], index=dates
+    )
+    is_holiday = (holiday_names != "").to_numpy()
+    # Days off either side of each date (dates outside the range are
+    # treated as working days)
+    is_off = is_holiday | (dates.weekday >= 5)
+    prev_off = np.concatenate([[False], is_off[:-1]])
+    next_off = np.concatenate([is_off[1:], [False]])
+    df = pd.DataFrame(
+        {
+            "date": dates,
+            "is_holiday": is_holiday,
+            "holiday_name": holiday_names.to_numpy(),
+            "is_bridge_day": ~is_off & prev_off & next_off,
+        }
+    )
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_parquet(cache_filepath, index=False)
+    return df
+
+
+def get_calendar_table(
+    country_names, start_year, end_year, seasons=None, cache_dir=None
+):
+    """
+    Get table of calendar features for every country and date
+
+    Parameters
+    ----------
+    country_names : List
+        country codes, eg. DE or GB_GBN
+    start_year : int
+        first year
+    end_year : int
+        last year (inclusive)
+    seasons : Dict
+        mapping of month number (as str) to season name; months that are not
+        mapped have a missing season
+    cache_dir : str
+        directory in which holidays for each country are cached
+    Returns
+    -------
+    df_calendar : pd.DataFrame
+        one row per country and date (in that order), with columns country,
+        date and CALENDAR_COLS; country, holiday_name, month and season are
+        categoricals
+    """
+    dfs = [
+        get_country_holiday_table(c, start_year, end_year, cache_dir)
+        for c in country_names
+    ]
+    df_calendar = pd.concat(dfs, ignore_index=True)
+    df_calendar.insert(
+        0,
+        "country",
+        pd.Categorical.from_codes(
+            np.repeat(np.arange(len(country_names)), [len(d) for d in dfs]),
+            categories=list(country_names),
+        ),
+    )
+    dates = pd.DatetimeIndex(df_calendar["date"])
+    df_calendar["holiday_name"] = df_calendar["holiday_name"].astype(
+        "category"
+    )
+    df_calendar["weekday_int"] = dates.weekday.astype("int8")
+    df_calendar["is_weekend"] = df_calendar["weekday_int"] >= 5
+    df_calendar["month"] = pd.Categorical.from_codes(
+        dates.month - 1, categories=list(calendar.month_name)[1:]
+    )
+    season_names = pd.Index(dates.month.astype(str)).map(seasons or {})
+    df_calendar["season"] = pd.Categorical(season_names)
+    return df_calendar
+
+
+def add_calendar_features(
+    df,
+    df_calendar,
+    time_col="utc_timestamp",
+    country_col="country",
+    cols=CALENDAR_COLS,
+):
+    """
+    Add calendar features to (hourly) data, by date and country
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        data with datetime and country columns
+    df_calendar : pd.DataFrame
+        calendar table, from get_calendar_table()
+    cols : List
+        columns of calendar table to be added
+    Returns
+    -------
+    df : pd.DataFrame
+        input data, with calendar columns appended in place
+    Notes
+    -----
+    1. Instead of merging on (country, date), the row of the calendar table
+       for each row of the data is calculated from integer codes of the
+       country and date, and the calendar columns are looked up with .take().
+    2. Dates are taken from the datetimes as they are, eg. in UTC for
+       utc_timestamp.
+    """
+    countries = df_calendar["country"].cat.categories
+    first_date = df_calendar["date"].iloc[0]
+    num_dates = len(df_calendar) // len(countries)
+
+    codes, uniques = pd.factorize(df[country_col])
+    if (codes < 0).any():
+        raise ValueError("Missing countries, not found in calendar table")
+    country_codes = countries.get_indexer(uniques)[codes]
+    dates = df[time_col]
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    date_codes = (dates.dt.normalize() - first_date).dt.days.to_numpy(
+        dtype="int64"
+    )
+    if (country_codes < 0).any():
+        raise ValueError("Countries not found in calendar table")
+    if (date_codes < 0).any() or (date_codes >= num_dates).any():
+        raise ValueError("Dates outside range of calendar table")
+    positions = country_codes * num_dates + date_codes
+
+    for col in cols:
+        df[col] = df_calendar[col].take(positions).set_axis(df.index)
+    return df
+
+
+def get_prophet_holidays(df_calendar, country, include_bridge_days=False):
+    """Get holidays for a country from calendar table, for Prophet()."""
+    df_country = df_calendar[df_calendar["country"] == country]
+    df_holidays = df_country.loc[df_country["is_holiday"], ["date"]].assign(
+        holiday=df_country["holiday_name"].astype(str)
+    )
+    if include_bridge_days:
+        df_bridge_days = df_country.loc[
+            df_country["is_bridge_day"], ["date"]
+        ].assign(holiday="Bridge day")
+        df_holidays = pd.concat([df_holidays, df_bridge_days])
+    df_holidays = df_holidays.rename(columns={"date": "ds"})
+    return df_holidays[["holiday", "ds"]].sort_values("ds", ignore_index=True)
@@ -2,13 +2,38 @@
 # -*- coding: utf-8 -*-
 
 
+import warnings
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
 from sklearn.base import BaseEstimator, RegressorMixin, TransformerMixin
-from sklearn.utils.validation import check_array, check_X_y
+
+from src.data_prep_helpers import get_datetime_bound_value, get_datetime_values
+
+
+@lru_cache(maxsize=128)
+def get_horizon_index(last_datetime, horizon, freq="H"):
+    """Get <horizon> + 1 datetimes following the last observed datetime."""
+    fstart = last_datetime + pd.to_timedelta(1, unit=freq)
+    fend = fstart + pd.to_timedelta(horizon, unit=freq)
+    return pd.date_range(fstart, fend, freq=freq)
 
 
 class CustomNaiveRegressor(BaseEstimator, RegressorMixin):
+    """
+    Notes
+    -----
+    1. If ts_name_col is specified, .predict() accepts a long DataFrame with
+       multiple timeseries (eg. one per country), identified by
+       ts_name_col, and forecasts all timeseries in a single vectorized
+       pass. The forecast datetimes are computed once per unique last
+       datetime (and cached across calls), so timeseries sharing a
+       calendar share the same forecast datetimes.
+    2. .predict() also accepts a 2D array of shape (timeseries, time), and
+       returns an array of shape (timeseries, <horizon> + 1)
+    """
+
     def __init__(
         self,
         naive_strategy="slice",
@@ -17,6 +42,7 @@ class CustomNaiveRegressor(BaseEstimator, RegressorMixin):
         fcast_attrs=["temperature"],
         datetime_colname="date",
         freq="H",
+        ts_name_col=None,
     ):
         self.naive_strategy = naive_strategy
         self.lookback = lookback
@@ -24,11 +50,18 @@ class CustomNaiveRegressor(BaseEstimator, RegressorMixin):
         self.fcast_attrs = fcast_attrs
         self.datetime_colname = datetime_colname
         self.freq = freq
+        self.ts_name_col = ts_name_col
 
     def fit(self, X, y=None):
         return self
 
     def predict(self, X):
+        if isinstance(X, np.ndarray):
+            lb = self.lookback
+            return X[:, -lb:][:, : (self.horizon + 1)]
+        if self.ts_name_col is not None:
+            return self._predict_multi_ts(X)
+
         # make forecast
         if self.naive_strategy == "slice":
             lb = self.lookback
@@ -36,15 +69,43 @@ class CustomNaiveRegressor(BaseEstimator, RegressorMixin):
             X_pred = X_lookback[: (self.horizon + 1)].reset_index(drop=True)
 
         # Increment forecast datetimes forward in time by <horizon> time steps
-        fstart = X[self.datetime_colname].max() + pd.to_timedelta(
-            1, unit=self.freq
-        )
-        fend = fstart + pd.to_timedelta(self.horizon, unit=self.freq)
-        X_pred[self.datetime_colname] = pd.date_range(
-            fstart, fend, freq=self.freq
+        X_pred[self.datetime_colname] = get_horizon_index(
+            X[self.datetime_colname].max(), self.horizon, self.freq
         )
         return X_pred[[self.datetime_colname] + self.fcast_attrs]
 
+    def _predict_multi_ts(self, X):
+        X = X.sort_values([self.ts_name_col, self.datetime_colname])
+        ts_codes, ts_names = pd.factorize(X[self.ts_name_col], sort=True)
+        ends = np.cumsum(np.bincount(ts_codes))
+        starts = np.concatenate([[0], ends[:-1]])
+
+        # make forecast, by slicing the same rows as X[-lb:][:(horizon + 1)]
+        # from every timeseries
+        lookback_starts = np.maximum(ends - self.lookback, starts)
+        if ((ends - lookback_starts) < self.horizon + 1).any():
+            raise ValueError(
+                f"Timeseries must have at least {self.horizon + 1} rows "
+                "in the lookback window"
+            )
+        rows = lookback_starts[:, None] + np.arange(self.horizon + 1)
+        X_pred = X[self.fcast_attrs].iloc[rows.ravel()].reset_index(drop=True)
+
+        # Increment forecast datetimes forward in time by <horizon> time steps
+        last_datetimes = X[self.datetime_colname].to_numpy()[ends - 1]
+        fcast_datetimes = np.empty(rows.shape, dtype=last_datetimes.dtype)
+        for last_datetime in np.unique(last_datetimes):
+            fcast_datetimes[last_datetimes == last_datetime] = (
+                get_horizon_index(
+                    pd.Timestamp(last_datetime), self.horizon, self.freq
+                ).to_numpy()
+            )
+        X_pred.insert(0, self.datetime_colname, fcast_datetimes.ravel())
+        X_pred.insert(
+            0, self.ts_name_col, np.repeat(ts_names, self.horizon + 1)
+        )
+        return X_pred
+
     def fit_predict(self, X, y=None, **kwargs):
         self = self.fit(X)
         return self.predict(X)
@@ -54,6 +115,7 @@ class CustomNaiveRegressor(BaseEstimator, RegressorMixin):
             "naive_strategy": self.naive_strategy,
             "horizon": self.horizon,
             "fcast_attrs": self.fcast_attrs,
+            "ts_name_col": self.ts_name_col,
         }
 
     def set_params(self, **parameters):
@@ -92,6 +154,9 @@ class MultiTSCustomNaiveRegressor(BaseEstimator, RegressorMixin):
        - forecast horizon
        - out-of-sample data, on which .predict() will be called
     2. .predict() can be called on the out-of-sample data only
+    3. The history within each cutoff is stored (as history_) in an array of
+       shape (timeseries, cutoff, horizon step), so that .predict() is a
+       single mean over the cutoff axis
 
     Usage
     -----
@@ -148,50 +213,64 @@ class MultiTSCustomNaiveRegressor(BaseEstimator, RegressorMixin):
         self.ts_name_col = ts_name_col
 
     def fit(self, X, y=None, **fit_kws):
-        X = X.set_index(self.ts_name_col, append=True)
-        Xc, yc = check_X_y(X[[self.index_name]], X["y"].fillna(-999))
-        X = (
-            pd.DataFrame(Xc, index=X.index, columns=[self.index_name])
-            .assign(y=yc)
-            .replace(-999, np.nan)
-        ).reset_index(level=1)
-
-        # Assemble list of historical data before each specified cutoff
-        dfs_pred_ = []
+        self.ts_names_ = pd.Index(np.sort(X[self.ts_name_col].unique()))
+        ts_codes = self.ts_names_.get_indexer(X[self.ts_name_col])
+        times = pd.DatetimeIndex(X[self.index_name])
+        datetimes = get_datetime_values(times)
+        y = X["y"].to_numpy(dtype=float)
+
+        # Assemble history within each specified cutoff into an array of
+        # shape (timeseries, cutoff, horizon step)
+        steps_by_cutoff = []
         for naive_cutoff_ in self.naive_cutoffs:
-            low = X[self.index_name] >= naive_cutoff_[0]
-            high = X[self.index_name] <= naive_cutoff_[1]
-            df_pred = X[low & high][[self.ts_name_col, "ds", "y"]]
-            dfs_pred_.append(df_pred)
-
-        # Concatenate all data before cutoffs
-        self.df_pred_ = pd.concat(dfs_pred_, ignore_index=True)
+            # naive cutoffs are taken to be in the timezone of the datetimes
+            low = datetimes >= get_datetime_bound_value(
+                naive_cutoff_[0], times.tz
+            )
+            high = datetimes <= get_datetime_bound_value(
+                naive_cutoff_[1], times.tz
+            )
+            mask = low & high
+            # horizon step is the position of the datetime in the cutoff
+            cutoff_datetimes = np.unique(datetimes[mask])
+            steps = np.searchsorted(cutoff_datetimes, datetimes[mask])
+            steps_by_cutoff.append([mask, steps, len(cutoff_datetimes)])
+        num_steps = max(n for _, _, n in steps_by_cutoff)
+        self.history_ = np.full(
+            (len(self.ts_names_), len(self.naive_cutoffs), num_steps), np.nan
+        )
+        for k, (mask, steps, _) in enumerate(steps_by_cutoff):
+            self.history_[ts_codes[mask], k, steps] = y[mask]
         return self
 
     def predict(self, X):
-        X = X.set_index(self.ts_name_col, append=True)[[self.index_name]]
-        X = pd.DataFrame(
-            check_array(X), index=X.index, columns=list(X)
-        ).reset_index(1)
-
-        # Assemble out-of-sample dates for each timeseries being forecast
-        nrows = X[self.ts_name_col].nunique() * len(self.naive_cutoffs)
-
-        # Append column to concatenated data with future dates for which a
-        # forecast is required
-        df_pred_ = self.df_pred_.assign(
-            ds_true=list(X[self.index_name].unique()) * nrows
+        # Assemble out-of-sample dates and timeseries being forecast
+        future_datetimes = np.unique(X[self.index_name].to_numpy())
+        ts_names = np.sort(X[self.ts_name_col].unique())
+        ts_codes = self.ts_names_.get_indexer(ts_names)
+        if (ts_codes == -1).any():
+            raise ValueError(
+                f"Timeseries not seen in fit: {ts_names[ts_codes == -1]}"
+            )
+        num_steps = len(future_datetimes)
+        if num_steps > self.history_.shape[2]:
+            raise ValueError(
+                f"Number of out-of-sample dates ({num_steps}) exceeds length "
+                f"of naive cutoffs ({self.history_.shape[2]})"
+            )
+
+        # Mean (aggregation) of historical y values over all cutoffs, for
+        # each timeseries and future date
+        with warnings.catch_warnings():
+            # all cutoffs are missing for some timeseries and future dates
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            yhat = np.nanmean(self.history_[ts_codes, :, :num_steps], axis=1)
+
+        df_pred_ = pd.DataFrame(
+            {
+                self.ts_name_col: np.repeat(ts_names, num_steps),
+                self.index_name: np.tile(future_datetimes, len(ts_names)),
+                "yhat": yhat.ravel(),
+            }
         )
-
-        # GROUP BY over concatenated data by country and future date columns
-        # and compute the mean (aggregation) of historical y values
-        groupby_cols = [self.ts_name_col, f"{self.index_name}_true"]
-        df_pred_ = df_pred_.groupby(groupby_cols, as_index=False)["y"].mean()
-
-        # Rename columns in prediction
-        renaming_dict = {
-            "y": "yhat",
-            f"{self.index_name}_true": self.index_name,
-        }
-        df_pred_ = df_pred_.rename(columns=renaming_dict)
         return df_pred_
@@ -2,8 +2,165 @@
 # -*- coding: utf-8 -*-
 
 
+import numpy as np
 import pandas as pd
 
+# Start and end (inclusive) of COVID-19 shutdowns in 2020, by country
+CORONA_DATES = {
+    "BE": [
+        pd.to_datetime("2020-03-07 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+    "CH": [
+        pd.to_datetime("2020-03-07 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+    "CZ": [
+        pd.to_datetime("2020-03-14 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+    "DE": [
+        pd.to_datetime("2020-03-14 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+    "ES": [
+        pd.to_datetime("2020-03-14 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+    "FR": [
+        pd.to_datetime("2020-03-07 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+    "HR": [
+        pd.to_datetime("2020-03-21 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+    "IT": [
+        pd.to_datetime("2020-03-14 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+    "NL": [
+        pd.to_datetime("2020-03-14 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+    "PL": [
+        pd.to_datetime("2020-03-14 00:00:00"),
+        pd.to_datetime("2020-04-12 23:00:00"),
+    ],
+}
+
+
+def get_datetime_values(times) -> np.ndarray:
+    """
+    Get datetimes as int64 nanoseconds since the epoch (in UTC, if tz-aware)
+
+    Datetimes of any unit (eg. datetime64[us]) are converted to nanoseconds,
+    to be compared with values from get_datetime_bound_value().
+    """
+    return (
+        pd.DatetimeIndex(times).to_numpy(dtype="datetime64[ns]").view("int64")
+    )
+
+
+def get_datetime_bound_value(bound, tz=None) -> int:
+    """
+    Get datetime bound as int64 nanoseconds since the epoch (in UTC, if
+    tz-aware), where a naive bound is taken to be in timezone tz
+    """
+    bound = pd.Timestamp(bound)
+    if tz is not None and bound.tz is None:
+        bound = bound.tz_localize(tz)
+    return bound.value
+
+
+def add_regime_intervals(
+    df,
+    intervals,
+    time_col,
+    country_col="country",
+    label_col="regime",
+    add_indicators=False,
+):
+    """
+    Label rows with the (regime) interval, per country, that contains them
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        data with datetime and country columns
+    intervals : Dict
+        mapping of country to list of (start, end, label), where start and
+        end are inclusive (None for an open-ended interval); intervals of a
+        country must not overlap, and countries without intervals are not
+        labelled
+    time_col : str
+        datetime column
+    label_col : str
+        name of (categorical) column to which labels are written; rows
+        outside all intervals have a missing label
+    add_indicators : bool
+        whether to also add a boolean column per label
+    Returns
+    -------
+    df : pd.DataFrame
+        input data, with label column (and indicators) appended in place
+    Notes
+    -----
+    1. Rows of each country are labelled with a binary search of the
+       country's sorted interval starts, instead of merging intervals onto
+       the data.
+    """
+    labels = list(
+        dict.fromkeys(
+            label for ivls in intervals.values() for *_, label in ivls
+        )
+    )
+    times = pd.DatetimeIndex(df[time_col])
+    time_values = get_datetime_values(times)
+
+    def _to_value(bound, default):
+        if bound is None:
+            return default
+        return get_datetime_bound_value(bound, times.tz)
+
+    label_codes = np.full(len(df), -1, dtype="int16")
+    country_codes, countries = pd.factorize(df[country_col])
+    # Row positions of each country, contiguous after sorting by country
+    order = np.argsort(country_codes, kind="stable")
+    bounds = np.searchsorted(
+        country_codes[order], np.arange(len(countries) + 1)
+    )
+    for k, country in enumerate(countries):
+        if country not in intervals:
+            continue
+        country_intervals = sorted(
+            (
+                _to_value(start, np.iinfo("int64").min),
+                _to_value(end, np.iinfo("int64").max),
+                labels.index(label),
+            )
+            for start, end, label in intervals[country]
+        )
+        starts, ends, interval_label_codes = map(
+            np.array, zip(*country_intervals)
+        )
+        if (starts[1:] <= ends[:-1]).any():
+            raise ValueError(f"Overlapping intervals for {country}")
+        first_row, last_row = bounds[k], bounds[k + 1]
+        rows = order[first_row:last_row]
+        row_times = time_values[rows]
+        positions = np.searchsorted(starts, row_times, side="right") - 1
+        inside = (positions >= 0) & (
+            row_times <= ends[np.maximum(positions, 0)]
+        )
+        label_codes[rows[inside]] = interval_label_codes[positions[inside]]
+
+    df[label_col] = pd.Categorical.from_codes(label_codes, categories=labels)
+    if add_indicators:
+        for k, label in enumerate(labels):
+            df[label] = label_codes == k
+    return df
+
 
 def add_corona_dates(df, index_name, strategy=["during_corona", "no_corona"]):
     """
@@ -15,74 +172,18 @@ def add_corona_dates(df, index_name, strategy=["during_corona", "no_corona"]):
         - ['during_corona', 'no_corona']
         - ['pre_corona', 'during_corona', 'post_corona']
 
+    Rows of countries without corona dates are in none of the stages.
+
     SOURCE
     ------
     https://github.com/facebook/prophet/issues/1416#issuecomment-618553502
     """
-    d_corona = {
-        "BE": [
-            pd.to_datetime("2020-03-07 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-        "CH": [
-            pd.to_datetime("2020-03-07 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-        "CZ": [
-            pd.to_datetime("2020-03-14 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-        "DE": [
-            pd.to_datetime("2020-03-14 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-        "ES": [
-            pd.to_datetime("2020-03-14 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-        "FR": [
-            pd.to_datetime("2020-03-07 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-        "HR": [
-            pd.to_datetime("2020-03-21 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-        "IT": [
-            pd.to_datetime("2020-03-14 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-        "NL": [
-            pd.to_datetime("2020-03-14 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-        "PL": [
-            pd.to_datetime("2020-03-14 00:00:00"),
-            pd.to_datetime("2020-04-12 23:00:00"),
-        ],
-    }
-    df_corona = (
-        pd.DataFrame.from_dict(d_corona, orient="index")
-        .reset_index()
-        .rename(
-            columns={0: "corona_start", 1: "corona_end", "index": "country"}
-        )
-    )
-    df = df.merge(df_corona, on="country", how="left")
-
     # Add corona periods based on specified strategy
     strategies_dict = {
         "dn": ["during_corona", "no_corona"],
         "pdp": ["pre_corona", "during_corona", "post_corona"],
     }
-    if set(strategy) == set(strategies_dict["dn"]):
-        df["no_corona"] = (df[index_name] < df["corona_start"]) | (
-            df[index_name] > df["corona_end"]
-        )
-    elif set(strategy) == set(strategies_dict["pdp"]):
-        df["pre_corona"] = df[index_name] < df["corona_start"]
-        df["post_corona"] = df[index_name] > df["corona_end"]
-    else:
+    if set(strategy) not in [set(v) for v in strategies_dict.values()]:
         strategies = ""
         for _, v in strategies_dict.items():
             strategies += "['" + "', '".join(map(str, v)) + "'], "
@@ -90,7 +191,21 @@ def add_corona_dates(df, index_name, strategy=["during_corona", "no_corona"]):
         raise Exception(
             f"Unsupported corona strategy. Expected one of: {strategies}"
         )
-    df["during_corona"] = (df[index_name] >= df["corona_start"]) & (
-        df[index_name] <= df["corona_end"]
-    )
+    one_ns = pd.Timedelta(1, "ns")
+    intervals = {
+        country: [
+            (None, start - one_ns, "pre_corona"),
+            (start, end, "during_corona"),
+            (end + one_ns, None, "post_corona"),
+        ]
+        for country, (start, end) in CORONA_DATES.items()
+    }
+    df = add_regime_intervals(df, intervals, index_name, label_col="corona")
+    corona = df.pop("corona")
+    if set(strategy) == set(strategies_dict["dn"]):
+        df["no_corona"] = corona.isin(["pre_corona", "post_corona"])
+    else:
+        df["pre_corona"] = corona == "pre_corona"
+        df["post_corona"] = corona == "post_corona"
+    df["during_corona"] = corona == "during_corona"
     return df
@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 
 
+from functools import lru_cache
+
 import numpy as np
+import pandas as pd
 
 
 def calculate_daylight(day: int, latitude: float = 53.551086) -> float:
@@ -11,7 +14,8 @@ def calculate_daylight(day: int, latitude: float = 53.551086) -> float:
     Parameters
     ----------
     day : integer (required)
-        day of the week by number, starting at 0 (Monday)
+        day of the year by number, starting at 1 (1st of January), eg. from
+        .dt.dayofyear (not day of the week)
     latitude : float (required)
         latitude at which number of daylight hours in a day is required
         (default is taken as latitude of Hamburg since weather data is also
@@ -39,37 +43,138 @@ def calculate_daylight(day: int, latitude: float = 53.551086) -> float:
     return daylightamount
 
 
-def get_too_hot_cold(data, threshold=20):
-    # METHOD 1 - use GROUP BY
-    temps = data["temp"] - threshold
-    data["too_hot"] = temps.mask(temps < 0, other=0).abs()
-    data["too_cold"] = temps.mask(temps > 0, other=0).abs()
-    # # METHOD 2 - do not use GROUP BY
-    # hcs = []
-    # for c in data["country"].unique():
-    #     temps = data[data["country"] == c]["temp"] - threshold
-    #     too_hot = temps.mask(temps < 0, other=0).abs()
-    #     too_cold = temps.mask(temps > 0, other=0).abs()
-    #     hc = (
-    #         too_hot.rename("too_hot")
-    #         .to_frame()
-    #         .merge(
-    #             too_cold.rename("too_cold").to_frame(),
-    #             left_index=True,
-    #             right_index=True,
-    #             how="left",
-    #         )
-    #         .merge(
-    #             data[data["country"] == c][["ds"]],
-    #             left_index=True,
-    #             right_index=True,
-    #             how="left",
-    #         )
-    #         .assign(country=c)
-    #     )
-    #     hc = hc.sort_values(["ds"])
-    #     hcs.append(hc)
-    # data = data.merge(
-    #     pd.concat(hcs, ignore_index=True), on=["country", "ds"], how="left"
-    # )
+@lru_cache(maxsize=32)
+def get_daylight_table(latitudes: tuple) -> np.ndarray:
+    """
+    Get number of hours of daylight for every day of the year and latitude
+
+    Returns array of shape (367, len(latitudes)), where row is day of year
+    (row 0 is unused), so daylight for (day, latitude) is at [day, k].
+    """
+    days = np.arange(367)[:, None]
+    return calculate_daylight(days, np.asarray(latitudes)[None, :])
+
+
+def get_daylight(day, latitude) -> np.ndarray:
+    """
+    Get number of hours of daylight for arrays of day of year and latitude
+
+    Same as calculate_daylight(day, latitude), but the formula is only
+    evaluated once per day of year and unique latitude (using a cached
+    table), and values are looked up for each row with one .take().
+    Daylight is missing where latitude is missing.
+    """
+    latitude_codes, latitudes = pd.factorize(np.asarray(latitude))
+    # Missing latitudes (code -1) are looked up in an extra column of the
+    # table, for latitude nan
+    num_latitudes = len(latitudes) + 1
+    table = get_daylight_table(tuple(latitudes) + (np.nan,))
+    latitude_codes[latitude_codes < 0] = num_latitudes - 1
+    return table.take(np.asarray(day) * num_latitudes + latitude_codes)
+
+
+def get_segment_rolling_sums(values, segment_ids, window: int):
+    """
+    Get trailing rolling sums of an array, restarting at each segment
+
+    Rows are assumed to be ordered by time within each segment. Missing
+    values count as 0, and the first window - 1 rows of each segment are
+    summed over the available rows.
+    """
+    cumsums = np.concatenate([[0], np.nancumsum(values, dtype="float64")])
+    positions = np.arange(1, len(values) + 1)
+    segment_starts = np.flatnonzero(
+        np.concatenate([[True], segment_ids[1:] != segment_ids[:-1]])
+    )
+    row_segment_starts = segment_starts[
+        np.searchsorted(segment_starts, positions - 1, side="right") - 1
+    ]
+    window_starts = np.maximum(positions - window, row_segment_starts)
+    return cumsums[positions] - cumsums[window_starts]
+
+
+def add_comfort_degree_features(
+    data,
+    thresholds=20,
+    temp_col="temp",
+    country_col="country",
+    time_col=None,
+    windows=None,
+):
+    """
+    Add degree-hours above (too_hot) and below (too_cold) comfort thresholds
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        hourly temperature for one or more countries
+    thresholds : float, Dict or List
+        comfort temperature, or mapping of country to comfort temperature,
+        or list of these; with a list, columns are suffixed by the threshold
+        (eg. too_hot_18) or, for a mapping, by its position in the list
+    time_col : str
+        column by which rows are ordered within each country for rolling
+        sums; rows must already be in this order if not specified
+    windows : Dict
+        mapping of name to number of hours, eg. {"24h": 24, "7d": 168}, for
+        which trailing degree-days (rolling sum of degree-hours / 24) are
+        added per country, eg. as too_hot_dd_24h
+    Returns
+    -------
+    data : pd.DataFrame
+        input data, with (float32) columns appended in place
+    Notes
+    -----
+    1. Differences from all thresholds are calculated in a single
+       (rows x thresholds) float32 array, instead of per threshold and
+       country.
+    """
+    single_threshold = not isinstance(thresholds, list)
+    if single_threshold:
+        thresholds, suffixes = [thresholds], [""]
+    else:
+        suffixes = [
+            f"_{k}" if isinstance(t, dict) else f"_{t:g}"
+            for k, t in enumerate(thresholds)
+        ]
+    country_codes, countries = pd.factorize(data[country_col])
+    # (rows x thresholds) comfort temperatures
+    comfort_temps = np.empty((len(data), len(thresholds)), dtype="float32")
+    for k, t in enumerate(thresholds):
+        if isinstance(t, dict):
+            country_thresholds = np.array(
+                [t.get(c, np.nan) for c in countries], dtype="float32"
+            )
+            comfort_temps[:, k] = country_thresholds.take(country_codes)
+            # missing countries (code -1) have no comfort temperature
+            comfort_temps[country_codes < 0, k] = np.nan
+        else:
+            comfort_temps[:, k] = t
+
+    temps = data[temp_col].to_numpy(dtype="float32")
+    diffs = np.subtract(temps[:, None], comfort_temps, out=comfort_temps)
+    too_hot = np.maximum(diffs, 0)
+    too_cold = np.maximum(np.negative(diffs, out=diffs), 0, out=diffs)
+
+    if windows:
+        if time_col is None:
+            order = np.argsort(country_codes, kind="stable")
+        else:
+            time_codes = pd.factorize(data[time_col], sort=True)[0]
+            order = np.lexsort((time_codes, country_codes))
+        sorted_country_codes = country_codes[order]
+    for k, suffix in enumerate(suffixes):
+        for name, degree_hours in zip(
+            ["too_hot", "too_cold"], [too_hot, too_cold]
+        ):
+            data[f"{name}{suffix}"] = degree_hours[:, k]
+            for window_name, window in (windows or {}).items():
+                degree_days = np.empty(len(data), dtype="float32")
+                degree_days[order] = (
+                    get_segment_rolling_sums(
+                        degree_hours[order, k], sorted_country_codes, window
+                    )
+                    / 24
+                )
+                data[f"{name}_dd_{window_name}{suffix}"] = degree_days
     return data
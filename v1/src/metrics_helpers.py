@@ -2,9 +2,10 @@
 # -*- coding: utf-8 -*-
 
 
+from typing import NamedTuple, Optional
+
 import numpy as np
 import pandas as pd
-import sklearn.metrics as skm
 
 
 def rmspe_error(y_true, y_pred):
@@ -22,27 +23,295 @@ def smape_error(y_true, y_pred):
     return smape_val
 
 
-def score_predictions(y_true, y_pred, prediction_type="pred", get_r2=False):
-    rmse_score = skm.mean_squared_error(y_true, y_pred, squared=False)
-    mse_score = skm.mean_squared_error(y_true, y_pred)
-    # mape_score = skm.mean_absolute_percentage_error(y_true, y_pred) * 100
-    mae_score = skm.mean_absolute_error(y_true, y_pred)
-    smape_score = smape_error(y_true, y_pred)
-    scores = {
-        "rmse": rmse_score,
-        "mae": mae_score,
-        # "mape(%)": mape_score,
-        "smape(%)": smape_score,
-        "mse": mse_score,
-        "type": prediction_type,
-    }
+class PredictionScores(NamedTuple):
+    """Scores of predictions; r2 and rmspe are None if not calculated."""
+
+    rmse: float
+    mae: float
+    smape: float
+    mse: float
+    type: str = "pred"
+    r2: Optional[float] = None
+    rmspe: Optional[float] = None
+
+    def to_dict(self):
+        """Get scores as dict, with the keys used by score_predictions()."""
+        scores = {
+            "rmse": self.rmse,
+            "mae": self.mae,
+            "smape(%)": self.smape,
+            "mse": self.mse,
+            "type": self.type,
+        }
+        if self.r2 is not None:
+            scores["r2"] = self.r2
+        if self.rmspe is not None:
+            scores["rmspe(%)"] = self.rmspe
+        return scores
+
+
+def get_prediction_scores(
+    y_true, y_pred, prediction_type="pred", get_r2=False
+):
+    """
+    Calculate all scores of predictions, sharing intermediate arrays
+
+    Gives the same scores as score_predictions(), but the residuals are
+    calculated once (into a single buffer) and re-used for all scores, sums
+    of squares are calculated as dot products (without temporary arrays) and
+    only one other buffer is allocated.
+    """
+    y_true = np.asarray(y_true, dtype="float64")
+    y_pred = np.asarray(y_pred, dtype="float64")
+    n = len(y_true)
+
+    residuals = np.subtract(y_pred, y_true)
+    mse = np.dot(residuals, residuals) / n
+    buffer = np.empty_like(residuals)
+    # |y_pred| + |y_true|
+    np.abs(y_pred, out=buffer)
+    buffer += np.abs(y_true)
+    np.abs(residuals, out=residuals)
+    mae = residuals.sum() / n
+    smape = 200 * np.divide(residuals, buffer, out=residuals).sum() / n
+
+    r2 = None
     if get_r2:
-        scores.update({"r2": skm.r2_score(y_true, y_pred)})
+        np.subtract(y_true, y_true.mean(), out=buffer)
+        ss_tot = np.dot(buffer, buffer)
+        # same as skm.r2_score, for constant y_true
+        if ss_tot == 0:
+            r2 = 1.0 if mse == 0 else 0.0
+        else:
+            r2 = 1 - (mse * n) / ss_tot
+    rmspe = None
     if y_true.min() > 0:
-        scores.update({"rmspe(%)": rmspe_error(y_true, y_pred)})
-    return scores
+        np.subtract(y_true, y_pred, out=buffer)
+        buffer /= y_true
+        rmspe = np.sqrt(np.dot(buffer, buffer) / n) * 100
+    return PredictionScores(
+        rmse=np.sqrt(mse),
+        mae=mae,
+        smape=smape,
+        mse=mse,
+        type=prediction_type,
+        r2=r2,
+        rmspe=rmspe,
+    )
+
+
+def score_predictions(y_true, y_pred, prediction_type="pred", get_r2=False):
+    return get_prediction_scores(
+        y_true, y_pred, prediction_type, get_r2
+    ).to_dict()
+
+
+class ScoreAccumulator(object):
+    """
+    Running sums from which scores of predictions are calculated
+
+    Predictions can be added chunk by chunk with .update(), and accumulators
+    of different chunks (eg. folds, or worker processes) combined with
+    .merge(), so scores of long backtests are calculated without keeping all
+    predictions in memory. .result() gives the same scores as
+    get_prediction_scores() would for all predictions at once.
+
+    Usage
+    -----
+    > acc = ScoreAccumulator()
+    > for df_chunk in chunks:
+          acc.update(df_chunk["y"], df_chunk["yhat"])
+    > scores = acc.merge(other_acc).result(get_r2=True)
+
+    Notes
+    -----
+    1. Rows where the true or predicted value is missing are ignored.
+    2. For R2, the mean and sum of squared deviations of true values are
+       combined with the pairwise update of Chan et al., which is stable
+       for long series (unlike sums of true values and of their squares).
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.sum_sq_error = 0.0
+        self.sum_abs_error = 0.0
+        self.sum_smape = 0.0
+        self.sum_sq_pct_error = 0.0
+        self.num_nonpositive = 0
+        self.mean_true = 0.0
+        self.m2_true = 0.0
+
+    def _combine(self, n, mean_true, m2_true):
+        total = self.n + n
+        delta = mean_true - self.mean_true
+        self.m2_true += m2_true + delta * delta * self.n * n / total
+        self.mean_true += delta * n / total
+        self.n = total
+
+    def update(self, y_true, y_pred):
+        """Add predictions to running sums."""
+        y_true = np.asarray(y_true, dtype="float64")
+        y_pred = np.asarray(y_pred, dtype="float64")
+        available = ~(np.isnan(y_true) | np.isnan(y_pred))
+        if not available.all():
+            y_true, y_pred = y_true[available], y_pred[available]
+        if len(y_true) == 0:
+            return self
+
+        residuals = y_pred - y_true
+        self.sum_sq_error += np.dot(residuals, residuals)
+        abs_residuals = np.abs(residuals)
+        self.sum_abs_error += abs_residuals.sum()
+        self.sum_smape += (
+            abs_residuals / (np.abs(y_pred) + np.abs(y_true))
+        ).sum()
+        num_nonpositive = np.count_nonzero(y_true <= 0)
+        self.num_nonpositive += num_nonpositive
+        if num_nonpositive == 0:
+            residuals /= y_true
+            self.sum_sq_pct_error += np.dot(residuals, residuals)
+        mean_true = y_true.mean()
+        centered = y_true - mean_true
+        self._combine(len(y_true), mean_true, np.dot(centered, centered))
+        return self
+
+    def merge(self, other):
+        """Add running sums of another accumulator to these sums."""
+        if other.n == 0:
+            return self
+        self.sum_sq_error += other.sum_sq_error
+        self.sum_abs_error += other.sum_abs_error
+        self.sum_smape += other.sum_smape
+        self.sum_sq_pct_error += other.sum_sq_pct_error
+        self.num_nonpositive += other.num_nonpositive
+        self._combine(other.n, other.mean_true, other.m2_true)
+        return self
+
+    def result(self, prediction_type="pred", get_r2=False):
+        """Get scores of all predictions added so far."""
+        if self.n == 0:
+            raise ValueError("No predictions have been added")
+        mse = self.sum_sq_error / self.n
+        r2 = None
+        if get_r2:
+            # same as skm.r2_score, for constant y_true
+            if self.m2_true == 0:
+                r2 = 1.0 if mse == 0 else 0.0
+            else:
+                r2 = 1 - self.sum_sq_error / self.m2_true
+        rmspe = None
+        if self.num_nonpositive == 0:
+            rmspe = np.sqrt(self.sum_sq_pct_error / self.n) * 100
+        return PredictionScores(
+            rmse=np.sqrt(mse),
+            mae=self.sum_abs_error / self.n,
+            smape=200 * self.sum_smape / self.n,
+            mse=mse,
+            type=prediction_type,
+            r2=r2,
+            rmspe=rmspe,
+        )
 
 
 def groupwise_score_predictions(df_group, true="y", pred="ypred"):
     scores = score_predictions(df_group[true], df_group[pred])
     return pd.Series(scores)
+
+
+def get_grouped_scores(
+    group_codes, y_true, y_pred, num_groups=None, get_r2=False
+):
+    """
+    Calculate scores of predictions for every group of (integer-coded) rows
+
+    Parameters
+    ----------
+    group_codes : np.ndarray
+        group of each row, as integers from 0 to num_groups - 1
+    y_true, y_pred : np.ndarray
+        true and predicted values; rows where either is missing are ignored
+    num_groups : int
+        number of groups (default is largest code + 1)
+    Returns
+    -------
+    scores : Dict
+        mapping of score name (same as score_predictions()) to array of
+        scores, one per group; rmspe(%) is missing for groups with true
+        values that are not all positive
+    Notes
+    -----
+    1. Per-group sums are calculated with np.bincount, for all groups at
+       once.
+    """
+    y_true = np.asarray(y_true, dtype="float64")
+    y_pred = np.asarray(y_pred, dtype="float64")
+    group_codes = np.asarray(group_codes)
+    available = ~(np.isnan(y_true) | np.isnan(y_pred))
+    if not available.all():
+        group_codes = group_codes[available]
+        y_true, y_pred = y_true[available], y_pred[available]
+    if num_groups is None:
+        num_groups = group_codes.max() + 1
+
+    def _sums(values):
+        return np.bincount(group_codes, weights=values, minlength=num_groups)
+
+    n = _sums(None)
+    residuals = y_pred - y_true
+    abs_residuals = np.abs(residuals)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mse = _sums(residuals * residuals) / n
+        scores = {
+            "rmse": np.sqrt(mse),
+            "mae": _sums(abs_residuals) / n,
+            "smape(%)": 200
+            * _sums(abs_residuals / (np.abs(y_pred) + np.abs(y_true)))
+            / n,
+            "mse": mse,
+        }
+        if get_r2:
+            centered = y_true - (_sums(y_true) / n)[group_codes]
+            ss_tot = _sums(centered * centered)
+            # same as skm.r2_score, for constant y_true
+            scores["r2"] = np.where(
+                ss_tot == 0,
+                np.where(mse == 0, 1.0, 0.0),
+                1 - (mse * n) / ss_tot,
+            )
+        pct_residuals = residuals / y_true
+        rmspe = np.sqrt(_sums(pct_residuals * pct_residuals) / n) * 100
+    all_positive = _sums(y_true <= 0) == 0
+    scores["rmspe(%)"] = np.where(all_positive, rmspe, np.nan)
+    return scores
+
+
+def score_predictions_by_group(
+    df,
+    group_cols,
+    true="y",
+    pred="yhat",
+    prediction_type="pred",
+    get_r2=False,
+):
+    """
+    Calculate scores of predictions for every group, without groupby.apply
+
+    Returns one row per group, with group columns and the same scores as
+    score_predictions() (see get_grouped_scores()).
+    """
+    grouped = df.groupby(group_cols, sort=True, observed=True)
+    df_scores = grouped.size().index.to_frame(index=False)
+    # rows with missing group keys are in no group (missing or -1 code), and
+    # are dropped, same as by groupby.apply
+    group_codes = grouped.ngroup()
+    in_group = group_codes.notna() & (group_codes >= 0)
+    scores = get_grouped_scores(
+        group_codes[in_group].to_numpy(dtype="int64"),
+        df.loc[in_group, true],
+        df.loc[in_group, pred],
+        len(df_scores),
+        get_r2,
+    )
+    df_scores = df_scores.assign(**scores)
+    df_scores.insert(len(group_cols) + 4, "type", prediction_type)
+    return df_scores
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import calendar
+import hashlib
+import json
+import os
+import shutil
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+
+def get_file_hash(filepath, chunksize=2**20):
+    """Get SHA256 hash of a file's contents, read in chunks."""
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(chunksize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def download_opsd_data(opsd_data_url, raw_data_dir, overwrite=False):
+    """Download OPSD .csv file to raw data directory, if not present."""
+    csv_filepath = os.path.join(raw_data_dir, os.path.basename(opsd_data_url))
+    if overwrite or not os.path.exists(csv_filepath):
+        os.makedirs(raw_data_dir, exist_ok=True)
+        urllib.request.urlretrieve(opsd_data_url, csv_filepath)
+    return csv_filepath
+
+
+def get_load_columns(csv_filepath, load_col_name_str):
+    """Get names of load columns in header row of OPSD .csv file."""
+    cols = pd.read_csv(csv_filepath, nrows=0).columns
+    return [c for c in cols if c.endswith(f"_{load_col_name_str}")]
+
+
+def iter_opsd_csv_chunks(
+    csv_filepath,
+    load_col_name_str="load_actual_entsoe_transparency",
+    country_names=None,
+    seasons=None,
+    start_date=None,
+    end_date=None,
+    chunksize=24 * 7 * 4,
+    load_dtype="float32",
+):
+    """
+    Read OPSD .csv file in chunks of rows and yield long-format chunks
+
+    Parameters
+    ----------
+    csv_filepath : str
+        path to local copy of OPSD time_series_60min_singleindex.csv file
+    load_col_name_str : str
+        suffix of load columns to be read
+    country_names : List
+        prefixes of load columns to be read (eg. DE, GB_GBN); all load
+        columns are read if not specified
+    seasons : Dict
+        mapping of month number (as str) to season name; if specified, a
+        season column is added to each chunk
+    start_date : str
+        first datetime (inclusive) to keep, eg. "2015"
+    end_date : str
+        last period (inclusive) to keep, eg. "2020" keeps all of 2020
+    chunksize : int
+        number of (wide-format) rows of the .csv file to read per chunk
+    load_dtype : str
+        dtype to which load is converted while reading, eg. float64 to keep
+        the precision of the .csv file
+    Yields
+    ------
+    df : pd.DataFrame
+        long-format chunk with columns utc_timestamp, country (categorical),
+        load (load_dtype), month (categorical) and (optionally) season
+        (categorical); rows with missing load are dropped
+    Notes
+    -----
+    1. Categories are fixed before reading, so all chunks share the same
+       categories and can be concatenated without converting to object.
+    """
+    if country_names is None:
+        load_cols = get_load_columns(csv_filepath, load_col_name_str)
+        country_names = [
+            c.replace(f"_{load_col_name_str}", "") for c in load_cols
+        ]
+    else:
+        load_cols = [f"{c}_{load_col_name_str}" for c in country_names]
+    country_dtype = pd.CategoricalDtype(list(country_names))
+    month_dtype = pd.CategoricalDtype(list(calendar.month_name)[1:])
+    if seasons:
+        season_dtype = pd.CategoricalDtype(sorted(set(seasons.values())))
+        # month number (1-12) -> season code (-1 for months with no season)
+        season_codes = np.array(
+            [
+                (
+                    season_dtype.categories.get_loc(seasons[str(m)])
+                    if str(m) in seasons
+                    else -1
+                )
+                for m in range(13)
+            ]
+        )
+    start = pd.Timestamp(start_date, tz="UTC") if start_date else None
+    end = pd.Period(end_date).end_time.tz_localize("UTC") if end_date else None
+
+    reader = pd.read_csv(
+        csv_filepath,
+        usecols=load_cols + ["utc_timestamp"],
+        dtype={c: load_dtype for c in load_cols},
+        parse_dates=["utc_timestamp"],
+        chunksize=chunksize,
+    )
+    for df_wide in reader:
+        if start is not None:
+            df_wide = df_wide[df_wide["utc_timestamp"] >= start]
+        if end is not None:
+            df_wide = df_wide[df_wide["utc_timestamp"] <= end]
+        if df_wide.empty:
+            continue
+
+        # Reshape wide-to-long (row-major), without a stacked MultiIndex
+        loads = df_wide[load_cols].to_numpy(dtype=load_dtype).ravel()
+        timestamps = np.repeat(df_wide["utc_timestamp"].array, len(load_cols))
+        country_codes = np.tile(np.arange(len(load_cols)), len(df_wide))
+        mask = ~np.isnan(loads)
+        timestamps = timestamps[mask]
+        months = pd.DatetimeIndex(timestamps).month.to_numpy()
+        df = pd.DataFrame(
+            {
+                "utc_timestamp": timestamps,
+                "country": pd.Categorical.from_codes(
+                    country_codes[mask], dtype=country_dtype
+                ),
+                "load": loads[mask],
+                "month": pd.Categorical.from_codes(
+                    months - 1, dtype=month_dtype
+                ),
+            }
+        )
+        if seasons:
+            df["season"] = pd.Categorical.from_codes(
+                season_codes[months], dtype=season_dtype
+            )
+        yield df
+
+
+def read_opsd_csv(
+    csv_filepath,
+    load_col_name_str="load_actual_entsoe_transparency",
+    **kwargs,
+):
+    """Read OPSD .csv file in chunks and concatenate long-format chunks."""
+    return pd.concat(
+        iter_opsd_csv_chunks(csv_filepath, load_col_name_str, **kwargs),
+        ignore_index=True,
+    )
+
+
+def convert_opsd_csv_to_parquet(
+    csv_filepath,
+    dataset_dir,
+    load_col_name_str="load_actual_entsoe_transparency",
+    overwrite=False,
+):
+    """
+    Convert OPSD .csv file to a Parquet dataset partitioned by country, year
+
+    Parameters
+    ----------
+    csv_filepath : str
+        path to local copy of OPSD time_series_60min_singleindex.csv file
+    dataset_dir : str
+        directory in which to write Parquet dataset
+    load_col_name_str : str
+        suffix of load columns to be stored; the prefix of each column
+        (eg. DE, GB_GBN) is stored as the country partition
+    overwrite : bool
+        whether to re-create dataset even if the .csv file is unchanged
+    Returns
+    -------
+    converted : bool
+        whether the .csv file was (re-)converted
+    Notes
+    -----
+    1. The .csv file is converted chunk-by-chunk, so memory usage does not
+       depend on the size of the .csv file.
+    2. The hash of the .csv file, load column name and load dtype (float64,
+       the precision of the .csv file) are stored in
+       <dataset_dir>/_source.json (ignored by Parquet readers, since it
+       starts with an underscore). Conversion is skipped if these match the
+       current .csv file.
+    """
+    source_filepath = os.path.join(dataset_dir, "_source.json")
+    source = {
+        "sha256": get_file_hash(csv_filepath),
+        "load_col_name_str": load_col_name_str,
+        "load_dtype": "float64",
+    }
+    if not overwrite and os.path.exists(source_filepath):
+        with open(source_filepath) as f:
+            if json.load(f) == source:
+                return False
+
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    os.makedirs(dataset_dir)
+    chunks = iter_opsd_csv_chunks(
+        csv_filepath,
+        load_col_name_str,
+        chunksize=24 * 366,
+        load_dtype=source["load_dtype"],
+    )
+    for k, df in enumerate(chunks):
+        df = df[["utc_timestamp", "country", "load"]].assign(
+            year=df["utc_timestamp"].dt.year
+        )
+        # country is written as str, since all categories would otherwise be
+        # written as (empty) partitions
+        df["country"] = df["country"].astype(str)
+        df.to_parquet(
+            dataset_dir,
+            engine="pyarrow",
+            index=False,
+            partition_cols=["country", "year"],
+            basename_template=f"chunk{k}-{{i}}.parquet",
+        )
+    with open(source_filepath, "w") as f:
+        json.dump(source, f)
+    return True
+
+
+def read_opsd_parquet(
+    dataset_dir, start_date=None, end_date=None, country_names=None
+):
+    """
+    Read long-format load data from partitioned Parquet dataset
+
+    Parameters
+    ----------
+    dataset_dir : str
+        directory containing Parquet dataset
+    start_date : str
+        first datetime (inclusive) to load, eg. "2015" or "2015-01-01"
+    end_date : str
+        last period (inclusive) to load, eg. "2020" loads all of 2020, same
+        as .loc[slice(start_date, end_date)]
+    country_names : List
+        countries to load, as stored in the country partition (eg. DE, GB_GBN)
+    Returns
+    -------
+    df : pd.DataFrame
+        load data, with columns utc_timestamp, country, load, year
+    Notes
+    -----
+    1. Filters are pushed down to the Parquet reader, so only the required
+       country and year partitions (and matching row groups) are read.
+    """
+    filters = []
+    if country_names:
+        filters.append(("country", "in", list(country_names)))
+    if start_date:
+        start = pd.Timestamp(start_date, tz="UTC")
+        filters += [("year", ">=", start.year), ("utc_timestamp", ">=", start)]
+    if end_date:
+        end = pd.Period(end_date).end_time.tz_localize("UTC")
+        filters += [("year", "<=", end.year), ("utc_timestamp", "<=", end)]
+    df = pd.read_parquet(
+        dataset_dir, engine="pyarrow", filters=filters or None
+    )
+    df["country"] = df["country"].astype(str)
+    df["year"] = df["year"].astype(int)
+    df = df.sort_values(["country", "utc_timestamp"], ignore_index=True)
+    return df[["utc_timestamp", "country", "load", "year"]]
@@ -2,28 +2,318 @@
 # -*- coding: utf-8 -*-
 
 
+import math
+from bisect import bisect_left, insort
+from collections import deque
+
 import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import rank_filter
+
+# Scale of the MAD, for which it estimates the standard deviation of
+# normally distributed values
+MAD_SCALE = 1.4826
+
+
+def get_rolling_median_spread(values, window, segment_ids=None, method="std"):
+    """
+    Get centered rolling median and spread of one or more series
+
+    Parameters
+    ----------
+    values : np.ndarray
+        values of one or more series, concatenated
+    window : int
+        number of values in each window
+    segment_ids : np.ndarray
+        series of each value, with the values of each series contiguous and
+        ordered by time (default is a single series)
+    method : str
+        spread to be calculated, either std (standard deviation) or mad
+        (median absolute deviation, scaled by MAD_SCALE)
+    Returns
+    -------
+    median, spread : np.ndarray
+        same as .rolling(window, center=True).median() and .std() of each
+        series; missing where the window extends beyond the series or
+        contains missing values
+    Notes
+    -----
+    1. Medians are calculated with a 1D rank filter (O(n log window), since
+       scipy 1.14), so windows with missing values are calculated with these
+       values filled and then discarded.
+    2. Standard deviations are calculated from cumulative sums (O(n)) of
+       values centered on the mean of each series.
+    3. MADs are calculated from absolute deviations of each window (a view
+       of the values) from its median, sorted in chunks (O(n window log
+       window), fast for windows of a day or so).
+    """
+    values = np.asarray(values, dtype="float64")
+    if segment_ids is None:
+        segment_ids = np.zeros(len(values), dtype="int64")
+    else:
+        segment_ids = pd.factorize(segment_ids)[0]
+    n = len(values)
+    before, after = window // 2, (window - 1) // 2
+    if n < window:
+        return np.full(n, np.nan), np.full(n, np.nan)
+
+    # Windows that are within a series and have no missing values
+    positions = np.arange(n)
+    starts = np.clip(positions - before, 0, n - 1)
+    ends = np.clip(positions + after, 0, n - 1)
+    missing = np.isnan(values)
+    missing_cumsums = np.concatenate([[0], np.cumsum(missing)])
+    valid = (
+        (positions >= before)
+        & (positions + after < n)
+        & (segment_ids[starts] == segment_ids[ends])
+        & (missing_cumsums[ends + 1] == missing_cumsums[starts])
+    )
+    filled = np.where(missing, 0, values)
+
+    median = rank_filter(filled, (window - 1) // 2, window, mode="nearest")
+    if window % 2 == 0:
+        median += rank_filter(filled, window // 2, window, mode="nearest")
+        median /= 2
+
+    if method == "std":
+        num_values = np.bincount(segment_ids, weights=~missing)
+        means = np.bincount(segment_ids, weights=filled) / np.maximum(
+            num_values, 1
+        )
+        centered = filled - means[segment_ids]
+        centered[missing] = 0
+        sums = np.concatenate([[0], np.cumsum(centered)])
+        sums = sums[ends + 1] - sums[starts]
+        np.square(centered, out=centered)
+        sq_sums = np.concatenate([[0], np.cumsum(centered)])
+        sq_sums = sq_sums[ends + 1] - sq_sums[starts]
+        variance = (sq_sums - sums * sums / window) / (window - 1)
+        spread = np.sqrt(np.maximum(variance, 0))
+    elif method == "mad":
+        spread = np.full(n, np.nan)
+        windows = sliding_window_view(filled, window)
+        chunksize = 2**15
+        for chunk_start in range(0, len(windows), chunksize):
+            positions = np.arange(
+                chunk_start + before,
+                min(chunk_start + chunksize, len(windows)) + before,
+            )
+            deviations = np.abs(
+                windows[positions - before] - median[positions, None]
+            )
+            # Sorting short rows is faster than np.median (partitioning)
+            deviations.sort(axis=1)
+            spread[positions] = (
+                deviations[:, (window - 1) // 2] + deviations[:, window // 2]
+            ) * (MAD_SCALE / 2)
+    else:
+        raise ValueError(f"Unsupported spread method {method}")
+    median[~valid] = np.nan
+    spread[~valid] = np.nan
+    return median, spread
+
+
+def get_outlier_mask(values, median, spread, num_spreads):
+    """Get mask of values at least num_spreads spreads from the median."""
+    return (values >= median + num_spreads * spread) | (
+        values <= median - num_spreads * spread
+    )
+
+
+def filter_outliers(
+    values, window=24, num_spreads=3, segment_ids=None, method="std"
+):
+    """
+    Replace outliers with missing values, in place
+
+    Outliers are values at least num_spreads spreads (std or MAD) from the
+    centered rolling median, calculated with get_rolling_median_spread().
+    values must be a writeable float array. Returns mask of outliers.
+    """
+    median, spread = get_rolling_median_spread(
+        values, window, segment_ids, method
+    )
+    mask = get_outlier_mask(values, median, spread, num_spreads)
+    values[mask] = np.nan
+    return mask
+
+
+def filter_outliers_by_group(
+    df, window=24, num_spreads=3, group_col="country", col="y", method="std"
+):
+    """
+    Replace outliers with missing values, for every series of a long frame
 
+    Parameters
+    ----------
+    df : pd.DataFrame
+        one or more series, with rows ordered by time within each series
+        (rows of different series may be interleaved)
+    group_col : str
+        column by which series are identified
+    col : str
+        column from which outliers are filtered
+    (remaining parameters are the same as for filter_outliers())
+    Returns
+    -------
+    df : pd.DataFrame
+        input data, with outliers in col replaced in place by missing values
+    """
+    codes = pd.factorize(df[group_col])[0]
+    order = np.argsort(codes, kind="stable")
+    values = df[col].to_numpy(dtype="float64")[order]
+    filter_outliers(values, window, num_spreads, codes[order], method)
+    filtered = np.empty_like(values)
+    filtered[order] = values
+    df[col] = filtered
+    return df
 
-def median_filter_outliers(df_train, df_val, window=24 * 1, std=3):
+
+class IncrementalOutlierFilter(object):
+    """
+    Stateful outlier filter, for data that follows the data it is fitted on
+
+    Each value is compared with the median and spread (std or MAD) of a
+    trailing window of raw values, ending with the value itself, so no later
+    values are used. The window of the last values seen (from .fit() and
+    earlier calls to .transform()) is kept, so data can be filtered one
+    value or batch at a time, eg. hour by hour in a forecast service.
+
+    Usage
+    -----
+    > outlier_filter = IncrementalOutlierFilter(24, 3).fit(df_train["y"])
+    > y_val = outlier_filter.transform(df_val["y"])
+    > y_next_hour = outlier_filter.transform([value])
+
+    Notes
+    -----
+    1. Values are not compared if their window has missing values or has
+       not been filled yet, the same as get_rolling_median_spread() for
+       windows ending at each value.
+    2. Values of the window are kept in a sorted list: finding a value's
+       position takes O(log window) (bisect), but inserting and removing it
+       shift the list, which is O(window) per value (a fast memmove, for
+       windows of a day or so), after which the median is read in O(1).
+       Sums for the std are updated in O(1), and recalculated once per
+       window (O(1) amortised) to avoid drift. The MAD sorts the deviations
+       of the window, which is O(window log window) per value.
+    """
+
+    def __init__(self, window=24, num_spreads=3, method="std"):
+        if method not in ("std", "mad"):
+            raise ValueError(f"Unsupported spread method {method}")
+        self.window = window
+        self.num_spreads = num_spreads
+        self.method = method
+        self.reset()
+
+    def reset(self):
+        """Clear window of values seen."""
+        self.values = deque()
+        self.sorted_values = []
+        self.num_missing = 0
+        self.shift = None
+        self.sum = 0.0
+        self.sq_sum = 0.0
+        self.num_updates = 0
+
+    def fit(self, values):
+        """Keep window of the last values, to filter values following them."""
+        self.reset()
+        window = self.window
+        values = np.asarray(values, dtype="float64")
+        for value in values[-window:].tolist():
+            self._push(value)
+        return self
+
+    def _push(self, value):
+        if len(self.values) == self.window:
+            self._pop()
+        self.values.append(value)
+        if math.isnan(value):
+            self.num_missing += 1
+            return
+        insort(self.sorted_values, value)
+        if self.shift is None:
+            # Sums are of values shifted by the first value, for precision
+            self.shift = value
+        value -= self.shift
+        self.sum += value
+        self.sq_sum += value * value
+        self.num_updates += 1
+        if self.num_updates >= self.window:
+            shifted = np.asarray(self.sorted_values) - self.shift
+            self.sum, self.sq_sum = shifted.sum(), np.dot(shifted, shifted)
+            self.num_updates = 0
+
+    def _pop(self):
+        value = self.values.popleft()
+        if math.isnan(value):
+            self.num_missing -= 1
+            return
+        del self.sorted_values[bisect_left(self.sorted_values, value)]
+        value -= self.shift
+        self.sum -= value
+        self.sq_sum -= value * value
+
+    def _get_median_spread(self):
+        window, sorted_values = self.window, self.sorted_values
+        median = (
+            sorted_values[(window - 1) // 2] + sorted_values[window // 2]
+        ) / 2
+        if self.method == "std":
+            variance = (self.sq_sum - self.sum * self.sum / window) / (
+                window - 1
+            )
+            return median, np.sqrt(max(variance, 0))
+        deviations = np.sort(np.abs(np.asarray(sorted_values) - median))
+        spread = deviations[(window - 1) // 2] + deviations[window // 2]
+        return median, spread * (MAD_SCALE / 2)
+
+    def transform(self, values):
+        """
+        Get values with outliers replaced by missing values
+
+        Values are taken to follow (in time) the values seen so far, and are
+        added to the window.
+        """
+        filtered = np.array(values, dtype="float64", ndmin=1)
+        for k, value in enumerate(filtered.tolist()):
+            self._push(value)
+            if math.isnan(value) or self.num_missing > 0:
+                continue
+            if len(self.values) < self.window:
+                continue
+            median, spread = self._get_median_spread()
+            if (value >= median + self.num_spreads * spread) or (
+                value <= median - self.num_spreads * spread
+            ):
+                filtered[k] = np.nan
+        return filtered
+
+
+def median_filter_outliers(
+    df_train, df_val, window=24 * 1, std=3, method="std"
+):
+    # Outliers are replaced in the y column of the given frames (the whole
+    # column is assigned), without copying the frames
     # train
-    medianv = df_train["y"].rolling(window, center=True).median()
-    stdv = df_train["y"].rolling(window, center=True).std()
+    y_train = df_train["y"].to_numpy(dtype="float64")
+    medianv, stdv = get_rolling_median_spread(y_train, window, method=method)
 
-    # transform train
-    mask = (df_train.loc[:, "y"] >= medianv + (std * stdv)) | (
-        df_train.loc[:, "y"] <= medianv - (std * stdv)
+    # transform val, with windows of the last raw values (of train, then of
+    # val) up to each value
+    df_val["y"] = (
+        IncrementalOutlierFilter(window, std, method)
+        .fit(y_train)
+        .transform(df_val["y"])
     )
-    df_train.loc[mask, "y"] = np.nan
-
-    # transform val
-    num_obs_from_end = len(df_val)
-    medianv_val = medianv.iloc[-num_obs_from_end:]
-    stdv_val = stdv.iloc[-num_obs_from_end:]
-    medianv_val.index = df_val.index
-    stdv_val.index = df_val.index
-    mask = (df_val.loc[:, "y"] >= medianv_val + (std * stdv_val)) | (
-        df_val.loc[:, "y"] <= medianv_val - (std * stdv_val)
+
+    # transform train
+    df_train["y"] = np.where(
+        get_outlier_mask(y_train, medianv, stdv, std), np.nan, y_train
     )
-    df_val.loc[mask, "y"] = np.nan
     return [df_train, df_val]
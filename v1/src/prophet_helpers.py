@@ -2,13 +2,17 @@
 # -*- coding: utf-8 -*-
 
 
+import time
+
+import numpy as np
 import pandas as pd
 from prophet import Prophet
 
+from src.calendar_helpers import get_prophet_holidays
 from src.custom_estimators import CustomNaiveRegressor
 from src.metrics_helpers import score_predictions
 from src.processing_helpers import median_filter_outliers
-from src.prophet_utils import suppress_stdout_stderr
+from src.prophet_utils import capture_fit_logs
 from src.visualization_helpers import generate_plots
 
 
@@ -23,9 +27,20 @@ def analyze(
     categoricals,
     primary_metric="rmse",
     show_plots=True,
+    future_nums=None,
+    model_cache=None,
+    fit_kwargs={},
+    score_accumulator=None,
 ):
-    with suppress_stdout_stderr():
-        m.fit(train)
+    with capture_fit_logs() as fit_logs:
+        try:
+            if model_cache is None:
+                m.fit(train, **fit_kwargs)
+            else:
+                m = model_cache.fit(m, train, **fit_kwargs)
+        except Exception:
+            print(f"Prophet fit failed, with logs:\n{fit_logs.get_logs()}")
+            raise
 
     # Predict
     future = m.make_future_dataframe(
@@ -33,7 +48,17 @@ def analyze(
     )
     # print(list(future))
     # display(future.head(2))
-    future_nums = CustomNaiveRegressor(**nums_fcast_params).fit_predict(train)
+    # Forecast numerical regressors, unless already forecast (for this
+    # timeseries only)
+    if future_nums is None:
+        future_nums = CustomNaiveRegressor(**nums_fcast_params).fit_predict(
+            train
+        )
+    if future_nums["ds"].duplicated().any():
+        raise ValueError(
+            "Forecast numerical regressors have duplicated ds, eg. from "
+            "multiple timeseries"
+        )
     # print(list(future_nums))
     # display(future_nums.head(2).append(future_nums.tail(2)))
     future = future_nums.merge(future, on=["ds"]).merge(
@@ -67,6 +92,8 @@ def analyze(
     scores_dict = score_predictions(
         future_no_nan["y"], future_no_nan["yhat"], get_r2=True
     )
+    if score_accumulator is not None:
+        score_accumulator.update(future_no_nan["y"], future_no_nan["yhat"])
 
     # Plot Prophet model components
     if show_plots:
@@ -74,20 +101,22 @@ def analyze(
     return [forecast, future_forecast, scores_dict]
 
 
-def train_score_model(
-    df_train_val_test,
+def get_model(
     params,
     country,
     seasonalities,
     custom_seasonalities,
-    horizon,
-    test_start,
-    test_end,
     nums_fcast_params,
-    categoricals,
-    primary_metric="rmse",
+    prophet_cls=Prophet,
+    df_calendar=None,
 ):
-    m = Prophet(**params).add_country_holidays(country_name=country)
+    if df_calendar is None:
+        m = prophet_cls(**params).add_country_holidays(country_name=country)
+    else:
+        # Same holidays as calendar features, from calendar table
+        m = prophet_cls(
+            **params, holidays=get_prophet_holidays(df_calendar, country)
+        )
     weather_attrs_to_forecast = nums_fcast_params["fcast_attrs"]
     if weather_attrs_to_forecast:
         for regressor in nums_fcast_params["fcast_attrs"]:
@@ -98,11 +127,105 @@ def train_score_model(
     if custom_seasonalities:
         for custom_seasonality_params in custom_seasonalities:
             m.add_seasonality(**custom_seasonality_params)
+    return m
+
+
+def get_scores_df(
+    scores_dict,
+    country,
+    test_start,
+    test_end,
+    params,
+    weather_attrs_to_forecast,
+    seasonalities,
+    custom_seasonalities,
+):
+    df_scores = (
+        pd.DataFrame.from_dict(scores_dict, orient="index")
+        .T.assign(country=country)
+        .assign(test_start=test_start)
+        .assign(test_end=test_end)
+        .assign(params=str(params))
+        .assign(weather_attrs_to_forecast=",".join(weather_attrs_to_forecast))
+        .assign(seasonalities=",".join([s["name"] for s in seasonalities]))
+        .assign(
+            custom_seasonalities=",".join(
+                [cs["name"] for cs in custom_seasonalities]
+            )
+        )
+    )
+    return df_scores
+
+
+def get_warm_start_params(m):
+    """
+    Get fitted parameters of Prophet model, to initialize fit of another model
 
+    SOURCE: https://facebook.github.io/prophet/docs/additional_topics.html
+    """
+    res = {}
+    for pname in ["k", "m", "sigma_obs"]:
+        if m.mcmc_samples == 0:
+            res[pname] = m.params[pname][0][0]
+        else:
+            res[pname] = np.mean(m.params[pname])
+    for pname in ["delta", "beta"]:
+        if m.mcmc_samples == 0:
+            res[pname] = m.params[pname][0]
+        else:
+            res[pname] = np.mean(m.params[pname], axis=0)
+    return res
+
+
+def get_num_iterations(m):
+    """Get number of optimizer iterations used to fit Prophet model."""
+    try:
+        return len(m.stan_fit.optimized_iterations_np)
+    except Exception:
+        # iterations were not saved, or not fit by optimization
+        return np.nan
+
+
+def train_score_model(
+    df_train_val_test,
+    params,
+    country,
+    seasonalities,
+    custom_seasonalities,
+    horizon,
+    test_start,
+    test_end,
+    nums_fcast_params,
+    categoricals,
+    primary_metric="rmse",
+    future_nums=None,
+    prophet_cls=Prophet,
+    model_cache=None,
+    df_calendar=None,
+):
+    m = get_model(
+        params,
+        country,
+        seasonalities,
+        custom_seasonalities,
+        nums_fcast_params,
+        prophet_cls,
+        df_calendar,
+    )
+
+    # Outliers are filtered in place, in the frames of df_train_val_test
     df_train_val, df_test = median_filter_outliers(
-        df_train_val_test[0].copy(), df_train_val_test[1].copy(), 24, std=8
+        df_train_val_test[0], df_train_val_test[1], 24, std=8
     )
 
+    # Select this country's forecast, from numerical regressors forecast for
+    # all timeseries with CustomNaiveRegressor(ts_name_col=...)
+    ts_name_col = nums_fcast_params.get("ts_name_col") or "country"
+    if future_nums is not None and ts_name_col in future_nums:
+        future_nums = future_nums[future_nums[ts_name_col] == country].drop(
+            columns=[ts_name_col]
+        )
+
     _, future_forecast, scores_dict = analyze(
         m,
         df_train_val,
@@ -114,19 +237,143 @@ def train_score_model(
         categoricals,
         primary_metric,
         False,
+        future_nums,
+        model_cache,
     )
-    df_scores = (
-        pd.DataFrame.from_dict(scores_dict, orient="index")
-        .T.assign(country=country)
-        .assign(test_start=test_start)
-        .assign(test_end=test_end)
-        .assign(params=str(params))
-        .assign(weather_attrs_to_forecast=",".join(weather_attrs_to_forecast))
-        .assign(seasonalities=",".join([s["name"] for s in seasonalities]))
-        .assign(
-            custom_seasonalities=",".join(
-                [cs["name"] for cs in custom_seasonalities]
-            )
-        )
+    df_scores = get_scores_df(
+        scores_dict,
+        country,
+        test_start,
+        test_end,
+        params,
+        nums_fcast_params["fcast_attrs"],
+        seasonalities,
+        custom_seasonalities,
     )
     return [future_forecast.assign(country=country), df_scores]
+
+
+def train_score_rolling_model(
+    df,
+    cutoffs,
+    params,
+    country,
+    seasonalities,
+    custom_seasonalities,
+    horizon,
+    nums_fcast_params,
+    categoricals,
+    primary_metric="rmse",
+    warm_start=True,
+    prophet_cls=Prophet,
+    df_calendar=None,
+    score_accumulator=None,
+):
+    """
+    Train and score Prophet model over consecutive (rolling) cutoffs
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        data for a single country, with columns ds, y, numerical regressors
+        and categoricals
+    cutoffs : List
+        list of [train_start, train_end, test_start, test_end], in
+        chronological order
+    warm_start : bool
+        whether to initialize the fit for each cutoff with the parameters
+        (k, m, delta, beta, sigma_obs) fitted for the previous cutoff
+    df_calendar : pd.DataFrame
+        calendar table (from calendar_helpers.get_calendar_table()), from
+        which holidays are added to the model, instead of
+        .add_country_holidays()
+    score_accumulator : ScoreAccumulator
+        accumulator (from metrics_helpers) to which predictions for each
+        cutoff are added, to get scores over all cutoffs with .result()
+    (remaining parameters are the same as for train_score_model())
+    Returns
+    -------
+    future_forecast : pd.DataFrame
+        forecasts for all cutoffs
+    df_scores : pd.DataFrame
+        scores for all cutoffs, with the same columns as the scores from
+        train_score_model()
+    df_fits : pd.DataFrame
+        number of optimizer iterations (missing if fitted by MCMC) and
+        wall-time (seconds) for each cutoff
+    """
+    init = None
+    future_forecasts, dfs_scores, fits = [], [], []
+    for train_start, train_end, test_start, test_end in cutoffs:
+        start_time = time.time()
+        m = get_model(
+            params,
+            country,
+            seasonalities,
+            custom_seasonalities,
+            nums_fcast_params,
+            prophet_cls,
+            df_calendar,
+        )
+        # .take() gives new frames (not flagged as slices of df), whose y
+        # column is replaced by median_filter_outliers()
+        train_rows = np.flatnonzero(
+            (df["ds"] >= train_start) & (df["ds"] <= train_end)
+        )
+        test_rows = np.flatnonzero(
+            (df["ds"] >= test_start) & (df["ds"] <= test_end)
+        )
+        df_train_val, df_test = median_filter_outliers(
+            df.take(train_rows), df.take(test_rows), 24, std=8
+        )
+        fit_kwargs = {}
+        if m.mcmc_samples == 0:
+            # Iterations can only be saved when fitting by optimization, not
+            # by sampling (MCMC)
+            fit_kwargs["save_iterations"] = True
+        if warm_start and init is not None:
+            fit_kwargs["init"] = init
+        _, future_forecast, scores_dict = analyze(
+            m,
+            df_train_val,
+            df_test,
+            horizon,
+            test_start,
+            test_end,
+            nums_fcast_params,
+            categoricals,
+            primary_metric,
+            False,
+            fit_kwargs=fit_kwargs,
+            score_accumulator=score_accumulator,
+        )
+        init = get_warm_start_params(m)
+
+        future_forecasts.append(future_forecast.assign(country=country))
+        dfs_scores.append(
+            get_scores_df(
+                scores_dict,
+                country,
+                test_start,
+                test_end,
+                params,
+                nums_fcast_params["fcast_attrs"],
+                seasonalities,
+                custom_seasonalities,
+            )
+        )
+        fits.append(
+            dict(
+                country=country,
+                train_start=train_start,
+                train_end=train_end,
+                warm_start=warm_start and len(fits) > 0,
+                num_iterations=get_num_iterations(m),
+                fold_time_s=time.time() - start_time,
+            )
+        )
+    return [
+        pd.concat(future_forecasts, ignore_index=True),
+        pd.concat(dfs_scores, ignore_index=True),
+        pd.DataFrame.from_records(fits),
+    ]
@@ -2,7 +2,29 @@
 # -*- coding: utf-8 -*-
 
 
+import contextvars
+import hashlib
+import inspect
+import json
+import logging
 import os
+import tempfile
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from prophet.serialize import model_from_json, model_to_json
+
+# Loggers whose messages are captured by capture_fit_logs
+FIT_LOGGER_NAMES = ["prophet", "prophet.models", "cmdstanpy"]
+
+# Attributes of an unfitted Prophet model that change the fitted model,
+# besides the parameters of Prophet() (added by .add_country_holidays(),
+# .add_regressor() and .add_seasonality())
+PROPHET_ADDED_ATTRS = ["country_holidays", "extra_regressors", "seasonalities"]
+
+# Parameters of Prophet() that do not change the fitted model
+PROPHET_IGNORED_PARAMS = ["self", "stan_backend"]
 
 
 class suppress_stdout_stderr(object):
@@ -14,17 +36,18 @@ class suppress_stdout_stderr(object):
     to stderr just before a script exits, and after the context manager has
     exited (at least, I think that is why it lets exceptions through).
 
+    Redirecting file descriptors is process-wide, so this must not be used
+    while fitting models in multiple threads (use capture_fit_logs instead).
+
     SOURCE: https://github.com/facebook/prophet/issues/223
 
     """
 
-    def __init__(self):
+    def __enter__(self):
         # Open a pair of null files
         self.null_fds = [os.open(os.devnull, os.O_RDWR) for x in range(2)]
         # Save the actual stdout (1) and stderr (2) file descriptors.
         self.save_fds = (os.dup(1), os.dup(2))
-
-    def __enter__(self):
         # Assign the null pointers to stdout and stderr.
         os.dup2(self.null_fds[0], 1)
         os.dup2(self.null_fds[1], 2)
@@ -33,6 +56,178 @@ class suppress_stdout_stderr(object):
         # Re-assign the real stdout/stderr back to (1) and (2)
         os.dup2(self.save_fds[0], 1)
         os.dup2(self.save_fds[1], 2)
-        # Close the null files
-        os.close(self.null_fds[0])
-        os.close(self.null_fds[1])
+        # Close the null files and saved file descriptors
+        for fd in self.null_fds + list(self.save_fds):
+            os.close(fd)
+
+
+class _FitLogFilter(logging.Filter):
+    """Divert log records emitted inside capture_fit_logs to its buffer."""
+
+    def filter(self, record):
+        buffer = _fit_log_buffer.get()
+        if buffer is None:
+            return True
+        buffer.append(record)
+        return False
+
+
+# Buffer of the capture_fit_logs context active in the current thread (or
+# task), if any
+_fit_log_buffer = contextvars.ContextVar("fit_log_buffer", default=None)
+_fit_log_filter = _FitLogFilter()
+
+
+class capture_fit_logs(object):
+    """
+    A context manager that captures log messages from Prophet and CmdStanPy
+    (eg. "Chain [1] start processing") emitted while fitting a model, instead
+    of printing them.
+
+    Messages are captured separately for each thread (and asyncio task), so
+    models can be fit concurrently. Only the last maxlen messages are kept.
+    No file descriptors are opened or redirected.
+
+    Usage
+    -----
+    > with capture_fit_logs() as fit_logs:
+          try:
+              m.fit(train)
+          except Exception:
+              print(fit_logs.get_logs())
+              raise
+    """
+
+    def __init__(self, maxlen=1000):
+        self.records = deque(maxlen=maxlen)
+
+    def __enter__(self):
+        # Filters are only added once per process
+        for logger_name in FIT_LOGGER_NAMES:
+            logger = logging.getLogger(logger_name)
+            if _fit_log_filter not in logger.filters:
+                logger.addFilter(_fit_log_filter)
+        self._token = _fit_log_buffer.set(self.records)
+        return self
+
+    def __exit__(self, *_):
+        _fit_log_buffer.reset(self._token)
+
+    def get_logs(self):
+        """Get captured log messages, one per line."""
+        return "\n".join(
+            f"{r.name} - {r.levelname} - {r.getMessage()}"
+            for r in self.records
+        )
+
+
+def hash_df(df):
+    """Get hash of the column names and contents of a DataFrame."""
+    sha = hashlib.sha256(str(list(df)).encode())
+    sha.update(pd.util.hash_pandas_object(df, index=False).to_numpy())
+    return sha.hexdigest()
+
+
+def get_model_config(m):
+    """Get all parameters of Prophet() and added attributes of a model."""
+    params = inspect.signature(type(m).__init__).parameters
+    attrs = [p for p in params if p not in PROPHET_IGNORED_PARAMS]
+    return {
+        attr: getattr(m, attr, None) for attr in attrs + PROPHET_ADDED_ATTRS
+    }
+
+
+def get_model_key(m, train, fit_kwargs={}):
+    """
+    Get hash of an unfitted Prophet model's configuration, data and keyword
+    arguments of .fit() (eg. init, iter, algorithm)
+    """
+
+    def _default(obj):
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            return hash_df(pd.DataFrame(obj))
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return str(obj)
+
+    config = dict(get_model_config(m), fit_kwargs=fit_kwargs)
+    config_str = json.dumps(config, sort_keys=True, default=_default)
+    sha = hashlib.sha256(config_str.encode())
+    sha.update(hash_df(train).encode())
+    return sha.hexdigest()
+
+
+class ProphetModelCache(object):
+    """
+    On-disk cache of fitted Prophet models, stored as JSON files
+
+    Models are looked up by a hash of the training data and of the model
+    configuration (all parameters of Prophet(), country holidays, regressors
+    and seasonalities) and of the keyword arguments of .fit(), so a model is
+    only fitted once for the same inputs.
+    When the total size of cached models exceeds max_size_bytes, the least
+    recently used models are deleted.
+
+    Usage
+    -----
+    > model_cache = ProphetModelCache("data/models", max_size_bytes=2**30)
+    > m = Prophet(**params).add_country_holidays(country_name="FR")
+    > m = model_cache.fit(m, train)
+    """
+
+    def __init__(self, cache_dir, max_size_bytes=2**30):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_filepath(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """Get fitted model from cache, or None if not cached."""
+        filepath = self._get_filepath(key)
+        try:
+            with open(filepath) as f:
+                m = model_from_json(f.read())
+            # Mark model as most recently used
+            os.utime(filepath)
+        except FileNotFoundError:
+            return None
+        return m
+
+    def put(self, key, m):
+        """Write fitted model to cache and evict least recently used."""
+        # Write to a temporary file first, so other processes never read a
+        # partially written model
+        fd, tmp_filepath = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(model_to_json(m))
+        os.replace(tmp_filepath, self._get_filepath(key))
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used models until within size limit."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, filepath in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                # already evicted by another process
+                pass
+            total_size -= size
+
+    def fit(self, m, train, **kwargs):
+        """Get fitted model from cache, or fit model and add it to cache."""
+        key = get_model_key(m, train, kwargs)
+        m_fitted = self.get(key)
+        if m_fitted is None:
+            m_fitted = m.fit(train, **kwargs)
+            self.put(key, m_fitted)
+        return m_fitted
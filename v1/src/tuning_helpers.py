@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from multiprocessing import cpu_count
+
+import pandas as pd
+from prophet import Prophet
+from sklearn.model_selection import ParameterGrid
+
+from src.prophet_helpers import train_score_model
+
+# Data shared by all jobs run in a worker process, set by _init_worker
+_WORKER_DATA = {}
+
+
+class StanBackendReusingProphet(Prophet):
+    """Prophet model that reuses the Stan backend loaded in its process."""
+
+    _stan_backend = None
+
+    def _load_stan_backend(self, stan_backend):
+        cls = type(self)
+        if cls._stan_backend is None:
+            super()._load_stan_backend(stan_backend)
+            cls._stan_backend = self.stan_backend
+        self.stan_backend = cls._stan_backend
+
+
+def get_job_id(job):
+    """Get hash of the specification of a tuning job."""
+    job_str = json.dumps(job, sort_keys=True, default=str)
+    return hashlib.sha256(job_str.encode()).hexdigest()[:16]
+
+
+def get_tuning_jobs(countries, params_grid, seasonality_sets, cutoffs):
+    """
+    Get tuning jobs for every combination of inputs
+
+    Parameters
+    ----------
+    countries : List
+        countries for which a Prophet model is to be trained
+    params_grid : Dict
+        mapping of Prophet() parameter name to list of values
+    seasonality_sets : List
+        list of dicts, with keys seasonalities and custom_seasonalities,
+        each of which is a list of parameters for .add_seasonality()
+    cutoffs : List
+        list of [train_start, train_end, test_start, test_end]
+    Returns
+    -------
+    jobs : List
+        list of dicts, one per job
+    """
+    jobs = []
+    for country, params, seasonality_set, cutoff in product(
+        countries, ParameterGrid(params_grid), seasonality_sets, cutoffs
+    ):
+        job = dict(
+            country=country,
+            params=params,
+            seasonalities=seasonality_set["seasonalities"],
+            custom_seasonalities=seasonality_set["custom_seasonalities"],
+            train_start=cutoff[0],
+            train_end=cutoff[1],
+            test_start=cutoff[2],
+            test_end=cutoff[3],
+        )
+        jobs.append(dict(job, job_id=get_job_id(job)))
+    return jobs
+
+
+def _init_worker(df, common_params):
+    _WORKER_DATA["df"] = df
+    _WORKER_DATA["common_params"] = common_params
+
+
+def _run_job(job):
+    df = _WORKER_DATA["df"]
+    df = df[df["country"] == job["country"]]
+    train = df[
+        (df["ds"] >= job["train_start"]) & (df["ds"] <= job["train_end"])
+    ]
+    test = df[(df["ds"] >= job["test_start"]) & (df["ds"] <= job["test_end"])]
+    _, df_scores = train_score_model(
+        [train.reset_index(drop=True), test.reset_index(drop=True)],
+        job["params"],
+        job["country"],
+        job["seasonalities"],
+        job["custom_seasonalities"],
+        test_start=job["test_start"],
+        test_end=job["test_end"],
+        prophet_cls=StanBackendReusingProphet,
+        **_WORKER_DATA["common_params"],
+    )
+    return df_scores.assign(
+        job_id=job["job_id"],
+        train_start=job["train_start"],
+        train_end=job["train_end"],
+    )
+
+
+def read_scores(scores_filepath):
+    """Read scores from .jsonl file, skipping incompletely written lines."""
+    records = []
+    if os.path.exists(scores_filepath):
+        with open(scores_filepath) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+    return pd.DataFrame.from_records(records)
+
+
+def append_scores(df_scores, scores_filepath):
+    """Append scores to .jsonl file, as one line per row."""
+    with open(scores_filepath, "a") as f:
+        f.write(df_scores.to_json(orient="records", lines=True).rstrip("\n"))
+        f.write("\n")
+
+
+def run_tuning_jobs(
+    df, jobs, common_params, scores_filepath, n_jobs=cpu_count()
+):
+    """
+    Train and score Prophet models for tuning jobs across processes
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        data for all countries, with columns country, ds, y, numerical
+        regressors and categoricals
+    jobs : List
+        tuning jobs, from get_tuning_jobs()
+    common_params : Dict
+        parameters passed to train_score_model() for all jobs (horizon,
+        nums_fcast_params, categoricals, primary_metric and, optionally,
+        df_calendar)
+    scores_filepath : str
+        path to .jsonl file to which scores from each job are appended
+    n_jobs : int
+        number of worker processes
+    Returns
+    -------
+    df_scores : pd.DataFrame
+        scores from all completed jobs, including those completed in
+        earlier (interrupted) runs
+    Notes
+    -----
+    1. Scores from each job are appended to scores_filepath as soon as the
+       job is completed. Jobs whose ID is found in this file are skipped,
+       so an interrupted run can be resumed by calling this function again
+       with the same inputs.
+    2. Data is sent to each worker process once (not once per job), and
+       each worker process loads the Stan model once.
+    """
+    df_scores = read_scores(scores_filepath)
+    completed_job_ids = set(df_scores.get("job_id", []))
+    jobs = [job for job in jobs if job["job_id"] not in completed_job_ids]
+    print(
+        f"Running {len(jobs)} jobs ({len(completed_job_ids)} already "
+        "completed)"
+    )
+
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        initializer=_init_worker,
+        initargs=(df, common_params),
+    ) as executor:
+        futures = {executor.submit(_run_job, job): job for job in jobs}
+        for k, future in enumerate(as_completed(futures)):
+            job = futures[future]
+            try:
+                df_scores = future.result()
+            except Exception as e:
+                print(f"Job {job['job_id']} ({job['country']}) failed: {e}")
+                continue
+            append_scores(df_scores, scores_filepath)
+            print(f"({k+1}/{len(jobs)}) completed job {job['job_id']}")
+    return read_scores(scores_filepath)
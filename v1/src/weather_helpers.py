@@ -2,87 +2,550 @@
 # -*- coding: utf-8 -*-
 
 
+import glob
 import os
+import re
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 from multiprocessing import cpu_count
 
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from joblib import Parallel, delayed
 from meteostat import Daily, Hourly, Point, Stations
+from scipy import sparse
+from sklearn.metrics.pairwise import haversine_distances
+from sklearn.neighbors import BallTree
 
+# Earth radius (m), as used by meteostat for distances to stations
+EARTH_RADIUS_M = 6371000
 
-def get_single_station_weather(
-    k,
-    row,
-    num_stations,
-    ks_wanted,
-    weather_data_dir,
-    location_type="from_station_name",
-    time_colname="startdatehour",
-    get_hourly=True,
-    verbose=False,
-):
-    start, end, lat, lon, from_station_id, c, tz = [row[k] for k in ks_wanted]
-    # print(start, end)
-    if verbose:
-        print(f"({k+1}/{num_stations}) {from_station_id}...", end="")
-    start_time = time.time()
+
+def fetch_meteostat_weather(lat, lon, start, end, tz, get_hourly=True):
+    """Fetch weather at a location from Meteostat (index is named time)."""
     if get_hourly:
         data = Hourly(Point(lat, lon), start, end, timezone=tz)
     else:
         data = Daily(Point(lat, lon), start, end)
     data = data.normalize()
     data = data.interpolate()
-    data = data.fetch().reset_index().rename(columns={"time": time_colname})
-    end_time = time.time()
-    if get_hourly:
-        # Convert time column in weather data to GMT / UTC timezone
-        data[time_colname] = pd.to_datetime(data[time_colname], utc=True)
-        # Convert time column in weather data to station's timezone
-        data[time_colname] = data[time_colname].dt.tz_convert(tz)
-        # Remove timezone from time column
-        data[time_colname] = data[time_colname].dt.tz_localize(None)
-        # DST 1/2 - Drop second duplicated entry in each Nov
-        data = data.drop_duplicates(subset=[time_colname], keep="first")
-        # DST 2/2 - Insert missing entry in each Mar with 'time' interpolation
-        data = (
-            data.set_index(time_colname)
-            .resample("H")
-            .mean()
-            .interpolate(method="time")
-            .reset_index()
-        )
-    if verbose:
-        print(f"done ({(end_time - start_time):.2f}s)...", end="")
+    return data.fetch()
+
 
-    data[location_type] = from_station_id
+def fix_dst_hourly_weather(data, tz, time_colname="startdatehour"):
+    """Convert hourly weather to station's local time, without DST gaps."""
+    # Convert time column in weather data to GMT / UTC timezone
+    data[time_colname] = pd.to_datetime(data[time_colname], utc=True)
+    # Convert time column in weather data to station's timezone
+    data[time_colname] = data[time_colname].dt.tz_convert(tz)
+    # Remove timezone from time column
+    data[time_colname] = data[time_colname].dt.tz_localize(None)
+    # DST 1/2 - Drop second duplicated entry in each Nov
+    data = data.drop_duplicates(subset=[time_colname], keep="first")
+    # DST 2/2 - Insert missing entry in each Mar with 'time' interpolation
     data = (
-        data.assign(country=c).assign(year=data[time_colname].dt.year)
-        # .drop(columns=["hour"])
+        data.set_index(time_colname)
+        .resample("H")
+        .mean()
+        .interpolate(method="time")
+        .reset_index()
     )
-    if get_hourly:
-        data["timezone"] = tz
-    parquet_filepath = os.path.join(
-        weather_data_dir, f"{from_station_id.replace(' ', '_')}.parquet"
+    return data
+
+
+def interpolate_segments(values, segment_ids):
+    """
+    Linearly interpolate missing values within each segment of an array
+
+    Same as .interpolate() on each segment (on an evenly spaced index), ie.
+    missing values after the last available value of a segment are filled
+    with that value, and missing values before the first available value
+    are not filled.
+    """
+    positions = np.arange(len(values))
+    available = ~np.isnan(values)
+    # previous and next available position, within the same segment
+    prev_pos = np.maximum.accumulate(np.where(available, positions, -1))
+    next_pos = np.minimum.accumulate(
+        np.where(available, positions, len(values))[::-1]
+    )[::-1]
+    has_prev = (prev_pos >= 0) & (
+        segment_ids[np.maximum(prev_pos, 0)] == segment_ids
+    )
+    has_next = (next_pos < len(values)) & (
+        segment_ids[np.minimum(next_pos, len(values) - 1)] == segment_ids
+    )
+    prev_pos = np.maximum(prev_pos, 0)
+    next_pos = np.minimum(next_pos, len(values) - 1)
+
+    filled = values.copy()
+    fill_prev = ~available & has_prev & ~has_next
+    filled[fill_prev] = values[prev_pos[fill_prev]]
+    interp = ~available & has_prev & has_next
+    weights = (positions[interp] - prev_pos[interp]) / (
+        next_pos[interp] - prev_pos[interp]
+    )
+    filled[interp] = values[prev_pos[interp]] + weights * (
+        values[next_pos[interp]] - values[prev_pos[interp]]
+    )
+    return filled
+
+
+def fix_dst_hourly_weather_batch(
+    data,
+    time_colname="startdatehour",
+    location_type="from_station_name",
+    tz_colname="timezone",
+):
+    """
+    Convert hourly weather for many stations to each station's local time
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        hourly weather for all stations, with UTC datetimes in time_colname,
+        station in location_type and the station's timezone in tz_colname;
+        all other columns must be numerical
+    Returns
+    -------
+    data : pd.DataFrame
+        weather on a gapless hourly grid (in local time, without timezone)
+        per station, sorted by station and time
+    Notes
+    -----
+    1. Gives the same result as fix_dst_hourly_weather for each station, but
+       converts timezones once per timezone (not per station) and inserts
+       and interpolates missing hours for all stations at once, instead of
+       resampling each station separately.
+    2. Datetimes are assumed to be on the hour.
+    """
+    value_cols = [
+        c for c in data if c not in [time_colname, location_type, tz_colname]
+    ]
+    station_codes, stations = pd.factorize(data[location_type], sort=True)
+    tz_codes, tzs = pd.factorize(data[tz_colname])
+    utc_datetimes = pd.DatetimeIndex(pd.to_datetime(data[time_colname]))
+    if utc_datetimes.tz is None:
+        utc_datetimes = utc_datetimes.tz_localize("UTC")
+    utc_hours = utc_datetimes.tz_convert(None).to_numpy()
+    utc_hours = utc_hours.astype("datetime64[h]").astype("int64")
+    # Convert time column to station's timezone, once per timezone
+    hours = np.empty(len(data), dtype="int64")
+    for k, tz in enumerate(tzs):
+        tz_mask = tz_codes == k
+        hours[tz_mask] = (
+            utc_datetimes[tz_mask]
+            .tz_convert(tz)
+            .tz_localize(None)
+            .to_numpy()
+            .astype("datetime64[h]")
+            .astype("int64")
+        )
+
+    # DST 1/2 - Drop second duplicated entry in each Nov, ie. keep earliest
+    # UTC datetime of each local datetime per station
+    # (sort by station, local hour and UTC offset, packed into one int64 key)
+    offsets = utc_hours - hours - (utc_hours - hours).min()
+    relative_hours = hours - hours.min()
+    key = station_codes * (relative_hours.max() + 1) + relative_hours
+    order = np.argsort(key * (offsets.max() + 1) + offsets, kind="stable")
+    station_codes, hours = station_codes[order], hours[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = (station_codes[1:] != station_codes[:-1]) | (
+        hours[1:] != hours[:-1]
+    )
+    order, station_codes, hours = order[keep], station_codes[keep], hours[keep]
+
+    # DST 2/2 - Insert missing entry in each Mar, on hourly grid per station
+    # (rows are sorted by station and time, so each station's first and last
+    # hours are at the boundaries of its rows)
+    starts = np.searchsorted(station_codes, np.arange(len(stations)))
+    ends = np.searchsorted(station_codes, np.arange(len(stations)), "right")
+    first_hours, last_hours = hours[starts], hours[ends - 1]
+    num_hours = last_hours - first_hours + 1
+    grid_offsets = np.concatenate([[0], np.cumsum(num_hours)[:-1]])
+    grid_station_codes = np.repeat(np.arange(len(stations)), num_hours)
+    grid_hours = (
+        np.arange(num_hours.sum())
+        - grid_offsets[grid_station_codes]
+        + first_hours[grid_station_codes]
+    )
+    grid_positions = (
+        grid_offsets[station_codes] + hours - first_hours[station_codes]
+    )
+
+    station_tz_codes = np.empty(len(stations), dtype="int64")
+    station_tz_codes[station_codes] = tz_codes[order]
+    df_grid = pd.DataFrame(
+        {
+            location_type: stations.take(grid_station_codes),
+            time_colname: grid_hours.astype("datetime64[h]").astype(
+                "datetime64[ns]"
+            ),
+            tz_colname: tzs.take(station_tz_codes[grid_station_codes]),
+        }
+    )
+    for col in value_cols:
+        values = np.full(len(df_grid), np.nan)
+        values[grid_positions] = data[col].to_numpy(dtype=float)[order]
+        df_grid[col] = interpolate_segments(values, grid_station_codes)
+    return df_grid
+
+
+def fix_dst_fetched_weather(
+    fetched_datas, rows, ks_wanted, time_colname="startdatehour"
+):
+    """
+    Fix DST of hourly weather retrieved for many stations, all at once
+
+    Parameters
+    ----------
+    fetched_datas : List
+        for each station, list of weather retrieved for each range of hours
+        (from fetch_single_station_weather())
+    rows : List
+        details of each station, with keys ks_wanted
+    Returns
+    -------
+    fixed_datas : List
+        for each station, list holding its weather on a gapless hourly grid
+        in local time (same as fix_dst_hourly_weather() for each range),
+        or an empty list if no ranges were retrieved
+    Notes
+    -----
+    1. All ranges of all stations are fixed with a single call to
+       fix_dst_hourly_weather_batch(). Each range is a separate segment,
+       since ranges retrieved incrementally are not contiguous.
+    """
+    tz_key = ks_wanted[6]
+    frames, segment_stations = [], []
+    for k, (datas, row) in enumerate(zip(fetched_datas, rows)):
+        for data in datas:
+            frames.append(
+                data.assign(
+                    **{
+                        time_colname: pd.to_datetime(
+                            data[time_colname], utc=True
+                        ),
+                        "timezone": row[tz_key],
+                        "segment": len(frames),
+                    }
+                )
+            )
+            segment_stations.append(k)
+    if not frames:
+        return [[] for _ in rows]
+    data = fix_dst_hourly_weather_batch(
+        pd.concat(frames, ignore_index=True), time_colname, "segment"
+    )
+    # Segments are numbered in order of stations, so each station's rows
+    # are contiguous
+    row_stations = np.asarray(segment_stations)[data.pop("segment")]
+    data = data.drop(columns=["timezone"])
+    boundaries = np.searchsorted(row_stations, np.arange(len(rows) + 1))
+    return [
+        [data.iloc[start:end].reset_index(drop=True)] if datas else []
+        for start, end, datas in zip(
+            boundaries[:-1], boundaries[1:], fetched_datas
+        )
+    ]
+
+
+def get_missing_hourly_ranges(existing_datetimes, start, end, stale_hours=0):
+    """
+    Get ranges of hours between start and end that are not yet available
+
+    Parameters
+    ----------
+    existing_datetimes : pd.Series
+        hourly datetimes already available
+    start : datetime
+        first hour required
+    end : datetime
+        last hour required
+    stale_hours : int
+        number of most recent available hours to be treated as missing (eg.
+        since they might have been revised since they were retrieved)
+    Returns
+    -------
+    missing_ranges : List
+        list of (first missing hour, last missing hour), one per
+        consecutive run of missing hours
+    """
+    existing = pd.DatetimeIndex(existing_datetimes)
+    if stale_hours and not existing.empty:
+        existing = existing[
+            existing <= existing.max() - pd.Timedelta(hours=stale_hours)
+        ]
+    required = pd.date_range(pd.Timestamp(start).ceil("H"), end, freq="H")
+    missing = required.difference(existing).to_series()
+    if missing.empty:
+        return []
+    run_ids = (missing.diff() != pd.Timedelta(hours=1)).cumsum()
+    return [(m.min(), m.max()) for _, m in missing.groupby(run_ids)]
+
+
+def get_station_file_prefix(from_station_id):
+    """Get prefix of files holding a station's weather in weather dataset."""
+    return from_station_id.replace(" ", "_").replace("/", "_")
+
+
+def get_weather_dataset_files(dataset_dir, from_station_id=None):
+    """
+    Get files of weather dataset, optionally only those of one station
+
+    Only files in country and year partitions are included, so other files
+    in dataset_dir (eg. weather saved by earlier versions) are ignored.
+    """
+    filepaths = glob.glob(
+        os.path.join(dataset_dir, "country=*", "year=*", "*.parquet")
+    )
+    if from_station_id is not None:
+        # Match whole file name, since station names can start with the
+        # name of another station (eg. Frankfurt and Frankfurt-Hahn)
+        pattern = re.compile(
+            rf"{re.escape(get_station_file_prefix(from_station_id))}-\d+"
+            r"\.parquet"
+        )
+        filepaths = [
+            f for f in filepaths if pattern.fullmatch(os.path.basename(f))
+        ]
+    return filepaths
+
+
+def write_weather_dataset(
+    data,
+    dataset_dir,
+    location_type="from_station_name",
+    compression="zstd",
+):
+    """
+    Write weather for one or more stations to partitioned Parquet dataset
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        weather, with columns country, year, station (location_type) and
+        (for hourly weather) timezone
+    dataset_dir : str
+        directory of Parquet dataset, partitioned by country and year
+    compression : str
+        Parquet compression codec (eg. zstd, snappy)
+    Notes
+    -----
+    1. Each station's weather is written to one file per partition, named
+       after the station, eg. country=DE/year=2020/Frankfurt_Airport-0.parquet.
+       Files previously written for the same station in the partitions of
+       data are deleted, so the data for a station and year is replaced by
+       re-writing it, and other years of the station are left as they are.
+    2. Station and timezone are stored as categoricals (dictionary-encoded).
+    """
+    for from_station_id, data_station in data.groupby(
+        location_type, observed=True, sort=False
+    ):
+        prefix = get_station_file_prefix(from_station_id)
+        partition_dirs = {
+            os.path.join(dataset_dir, f"country={c}", f"year={y}")
+            for c, y in data_station[["country", "year"]]
+            .drop_duplicates()
+            .itertuples(index=False)
+        }
+        for filepath in get_weather_dataset_files(
+            dataset_dir, from_station_id
+        ):
+            if os.path.dirname(filepath) in partition_dirs:
+                os.remove(filepath)
+        data_station = data_station.assign(
+            **{
+                col: data_station[col].astype(str).astype("category")
+                for col in [location_type, "timezone"]
+                if col in data_station
+            }
+        )
+        # country is written as str, since all categories would otherwise be
+        # written as (empty) partitions
+        data_station["country"] = data_station["country"].astype(str)
+        data_station.to_parquet(
+            dataset_dir,
+            engine="pyarrow",
+            index=False,
+            compression=compression,
+            partition_cols=["country", "year"],
+            basename_template=f"{prefix}-{{i}}.parquet",
+        )
+
+
+def read_weather_dataset(
+    dataset_dir,
+    country_names=None,
+    stations=None,
+    start_date=None,
+    end_date=None,
+    location_type="from_station_name",
+    time_colname="startdatehour",
+):
+    """
+    Read weather from partitioned Parquet dataset
+
+    Parameters
+    ----------
+    dataset_dir : str
+        directory of Parquet dataset, from write_weather_dataset()
+    country_names : List
+        countries to read
+    stations : List
+        stations (values of location_type) to read
+    start_date : str
+        first (local) datetime (inclusive) to read, eg. "2015-01-01"
+    end_date : str
+        last period (inclusive) to read, eg. "2020" reads all of 2020
+    Returns
+    -------
+    df : pd.DataFrame
+        weather sorted by station and time, with country, station and
+        timezone as categoricals; empty if no weather has been saved
+    Notes
+    -----
+    1. Filters are pushed down to the Parquet reader, so only the required
+       country and year partitions (and matching row groups) are read.
+    2. Only files written by write_weather_dataset() are read (see
+       get_weather_dataset_files()).
+    """
+    filepaths = get_weather_dataset_files(dataset_dir)
+    if not filepaths:
+        return pd.DataFrame()
+    filters = []
+    if country_names:
+        filters.append(("country", "in", list(country_names)))
+    if stations:
+        filters.append((location_type, "in", list(stations)))
+    if start_date:
+        start = pd.Timestamp(start_date)
+        filters += [("year", ">=", start.year), (time_colname, ">=", start)]
+    if end_date:
+        end = pd.Period(end_date).end_time
+        filters += [("year", "<=", end.year), (time_colname, "<=", end)]
+    dataset = ds.dataset(
+        filepaths,
+        format="parquet",
+        partitioning="hive",
+        partition_base_dir=dataset_dir,
     )
+    df = dataset.to_table(
+        filter=pq.filters_to_expression(filters) if filters else None
+    ).to_pandas()
+    df["country"] = df["country"].astype(str).astype("category")
+    df["year"] = df["year"].astype(int)
+    df = df.sort_values([location_type, time_colname], ignore_index=True)
+    return df
+
+
+def fetch_single_station_weather(
+    row,
+    ks_wanted,
+    weather_data_dir,
+    time_colname="startdatehour",
+    get_hourly=True,
+    incremental=False,
+    stale_hours=0,
+    data_source=fetch_meteostat_weather,
+):
+    """Retrieve (unprocessed) weather for a single station."""
+    start, end, lat, lon, from_station_id, c, tz = [row[k] for k in ks_wanted]
+    data_existing = None
+    if incremental and get_hourly:
+        data_existing = read_weather_dataset(
+            weather_data_dir,
+            [c],
+            [from_station_id],
+            location_type=ks_wanted[4],
+            time_colname=time_colname,
+        )
+    if data_existing is not None and not data_existing.empty:
+        fetch_ranges = get_missing_hourly_ranges(
+            data_existing[time_colname], start, end, stale_hours
+        )
+    else:
+        data_existing = None
+        fetch_ranges = [(start, end)]
+    datas = []
+    for fetch_start, fetch_end in fetch_ranges:
+        data = data_source(lat, lon, fetch_start, fetch_end, tz, get_hourly)
+        data = data.reset_index().rename(columns={"time": time_colname})
+        datas.append(data)
+    return [datas, data_existing]
+
+
+def save_station_weather(
+    data, weather_data_dir, location_type="from_station_name", verbose=False
+):
+    """Save weather for a single station, printing (not raising) errors."""
     try:
         if verbose:
             print(
-                f"saving to {os.path.basename(parquet_filepath+'.gzip')}",
+                f"saving to {os.path.basename(weather_data_dir)}",
                 end="...",
             )
-        data.to_parquet(
-            parquet_filepath + ".gzip",
-            engine="auto",
-            index=False,
-            compression="gzip",
-        )
+        write_weather_dataset(data, weather_data_dir, location_type)
         if verbose:
             print("done.")
     except Exception as e:
         if verbose:
             print(str(e))
 
+
+def process_single_station_weather(
+    datas,
+    data_existing,
+    row,
+    ks_wanted,
+    weather_data_dir,
+    location_type="from_station_name",
+    time_colname="startdatehour",
+    get_hourly=True,
+    verbose=False,
+):
+    """
+    Add station details and save weather for a single station
+
+    Hourly weather must already be in local time, without DST gaps (see
+    fix_dst_fetched_weather()).
+    """
+    start, end, lat, lon, from_station_id, c, tz = [row[k] for k in ks_wanted]
+    if datas:
+        data = pd.concat(datas, ignore_index=True)
+        data[location_type] = from_station_id
+        data = (
+            data.assign(country=c).assign(year=data[time_colname].dt.year)
+            # .drop(columns=["hour"])
+        )
+        if get_hourly:
+            data["timezone"] = tz
+
+    data_to_save = data
+    if data_existing is not None:
+        if not datas:
+            if verbose:
+                print("up-to-date.")
+            return data_existing
+        # Replace previously saved hours by newly retrieved hours
+        years_retrieved = data["year"].unique()
+        data = (
+            pd.concat([data_existing, data], ignore_index=True)[
+                list(dict.fromkeys(list(data) + list(data_existing)))
+            ]
+            .drop_duplicates(subset=[time_colname], keep="last")
+            .sort_values(time_colname, ignore_index=True)
+        )
+        # Only re-write years with newly retrieved hours
+        data_to_save = data[data["year"].isin(years_retrieved)]
+    save_station_weather(
+        data_to_save, weather_data_dir, location_type, verbose
+    )
+
     data[time_colname] = pd.to_datetime(data[time_colname])
     # for k, v in zip(
     #     keys_wanted[:-1],
@@ -92,6 +555,146 @@ def get_single_station_weather(
     return data
 
 
+def get_single_station_weather(
+    k,
+    row,
+    num_stations,
+    ks_wanted,
+    weather_data_dir,
+    location_type="from_station_name",
+    time_colname="startdatehour",
+    get_hourly=True,
+    verbose=False,
+    incremental=False,
+    stale_hours=0,
+    data_source=fetch_meteostat_weather,
+):
+    """
+    Get weather for a single station and save it to the weather dataset
+
+    Notes
+    -----
+    1. With incremental=True (hourly weather only), weather previously saved
+       for the station is read from the weather dataset (see
+       write_weather_dataset), and only the hours between start and end that
+       are not in the dataset (and the most recent stale_hours hours in the
+       dataset) are retrieved from the data source and merged into it.
+    2. data_source is a function with the same signature and output as
+       fetch_meteostat_weather, eg. a function returning local (fake) data
+       when testing.
+    """
+    from_station_id = row[ks_wanted[4]]
+    if verbose:
+        print(f"({k+1}/{num_stations}) {from_station_id}...", end="")
+    start_time = time.time()
+    datas, data_existing = fetch_single_station_weather(
+        row,
+        ks_wanted,
+        weather_data_dir,
+        time_colname,
+        get_hourly,
+        incremental,
+        stale_hours,
+        data_source,
+    )
+    end_time = time.time()
+    if verbose:
+        print(
+            f"done, {len(datas)} range(s) "
+            f"({(end_time - start_time):.2f}s)...",
+            end="",
+        )
+    if get_hourly:
+        datas = fix_dst_fetched_weather(
+            [datas], [row], ks_wanted, time_colname
+        )[0]
+    return process_single_station_weather(
+        datas,
+        data_existing,
+        row,
+        ks_wanted,
+        weather_data_dir,
+        location_type,
+        time_colname,
+        get_hourly,
+        verbose,
+    )
+
+
+def fetch_with_retries(fetch_func, num_retries=3, backoff_s=1, **kwargs):
+    """Call function, retrying with exponential backoff if it fails."""
+    for attempt in range(num_retries + 1):
+        try:
+            return fetch_func(**kwargs)
+        except Exception:
+            if attempt == num_retries:
+                raise
+            time.sleep(backoff_s * 2**attempt)
+
+
+def process_fetched_weather(
+    fetched,
+    rows,
+    ks_wanted,
+    weather_data_dir,
+    location_type="from_station_name",
+    time_colname="startdatehour",
+    get_hourly=True,
+):
+    """
+    Fix DST, add station details and save weather for many stations
+
+    Parameters
+    ----------
+    fetched : List
+        for each station, [datas, data_existing] from
+        fetch_single_station_weather()
+    rows : List
+        details of each station, with keys ks_wanted
+    Returns
+    -------
+    dfs_weather : List
+        for each station, its weather or the exception raised while
+        processing it
+    Notes
+    -----
+    1. DST of hourly weather is fixed for all stations at once, with
+       fix_dst_fetched_weather(). If this fails (eg. due to bad data from
+       one station), it is fixed for each station separately, so only the
+       stations with bad data fail.
+    """
+    fixed_datas = [None] * len(rows)
+    if get_hourly:
+        try:
+            fixed_datas = fix_dst_fetched_weather(
+                [datas for datas, _ in fetched], rows, ks_wanted, time_colname
+            )
+        except Exception:
+            pass
+    dfs_weather = []
+    for (datas, data_existing), fixed, row in zip(fetched, fixed_datas, rows):
+        try:
+            if get_hourly and fixed is None:
+                fixed = fix_dst_fetched_weather(
+                    [datas], [row], ks_wanted, time_colname
+                )[0]
+            dfs_weather.append(
+                process_single_station_weather(
+                    datas if fixed is None else fixed,
+                    data_existing,
+                    row,
+                    ks_wanted,
+                    weather_data_dir,
+                    location_type,
+                    time_colname,
+                    get_hourly,
+                )
+            )
+        except Exception as e:
+            dfs_weather.append(e)
+    return dfs_weather
+
+
 def get_weather_by_station(
     df_stations,
     keys_wanted,
@@ -99,45 +702,506 @@ def get_weather_by_station(
     location_type="from_station_name",
     time_colname="startdatehour",
     get_hourly=True,
+    incremental=False,
+    stale_hours=0,
+    data_source=fetch_meteostat_weather,
 ):
-    num_stations = df_stations[location_type].nunique()
+    """
+    Get weather for multiple stations, retrieving it in parallel processes
+
+    Weather is retrieved in worker processes, and then processed (fixing
+    DST for all stations at once, saving) in the calling process.
+    """
+    rows = [row for _, row in df_stations.iterrows()]
     executor = Parallel(n_jobs=cpu_count(), backend="multiprocessing")
     tasks = (
-        delayed(get_single_station_weather)(
-            k,
+        delayed(fetch_single_station_weather)(
             row,
-            num_stations,
             keys_wanted,
             weather_data_dir,
-            location_type,
             time_colname,
             get_hourly,
+            incremental,
+            stale_hours,
+            data_source,
         )
-        for k, (_, row) in enumerate(df_stations.iterrows())
+        for row in rows
+    )
+    fetched = executor(tasks)
+    dfs_weather = process_fetched_weather(
+        fetched,
+        rows,
+        keys_wanted,
+        weather_data_dir,
+        location_type,
+        time_colname,
+        get_hourly,
     )
-    dfs_weather = executor(tasks)
+    for df_weather in dfs_weather:
+        if isinstance(df_weather, Exception):
+            raise df_weather
     dfs_weather = pd.concat(dfs_weather, ignore_index=True)
     return dfs_weather
 
 
+def get_weather_by_station_threaded(
+    df_stations,
+    keys_wanted,
+    weather_data_dir,
+    location_type="from_station_name",
+    time_colname="startdatehour",
+    get_hourly=True,
+    incremental=False,
+    stale_hours=0,
+    data_source=fetch_meteostat_weather,
+    max_workers=8,
+    num_retries=3,
+    backoff_s=1,
+    timeout_s=300,
+):
+    """
+    Get weather for multiple stations, retrieving it with a pool of threads
+
+    Parameters
+    ----------
+    (parameters up to data_source are the same as for
+    get_weather_by_station())
+    max_workers : int
+        maximum number of stations for which weather is retrieved at the
+        same time
+    num_retries : int
+        number of times to retry retrieving a station's weather if it fails
+    backoff_s : float
+        seconds to wait before the first retry; this is doubled for each
+        subsequent retry
+    timeout_s : float
+        seconds after which retrieving a station's weather (including
+        retries) is abandoned
+    Returns
+    -------
+    dfs_weather : pd.DataFrame
+        weather for all stations whose weather was retrieved
+    df_failures : pd.DataFrame
+        stations whose weather could not be retrieved, with the error
+    Notes
+    -----
+    1. Retrieval (waiting on I/O) runs in threads, and processing of the
+       retrieved weather (fixing DST for all stations at once, saving) runs
+       in the calling thread once retrieval has completed.
+    2. A station that fails or times out does not stop retrieval of the
+       other stations. Threads cannot be interrupted, so a timed out
+       retrieval keeps running in the background until it returns.
+    """
+    rows = df_stations[
+        list(dict.fromkeys(keys_wanted + [location_type]))
+    ].to_dict("records")
+    fetch_start_times = {}
+
+    def _fetch(k):
+        fetch_start_times[k] = time.monotonic()
+        return fetch_with_retries(
+            fetch_single_station_weather,
+            num_retries,
+            backoff_s,
+            row=rows[k],
+            ks_wanted=keys_wanted,
+            weather_data_dir=weather_data_dir,
+            time_colname=time_colname,
+            get_hourly=get_hourly,
+            incremental=incremental,
+            stale_hours=stale_hours,
+            data_source=data_source,
+        )
+
+    fetched, failures = {}, []
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {executor.submit(_fetch, k): k for k in range(len(rows))}
+    while pending:
+        done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            k = pending.pop(future)
+            try:
+                fetched[k] = future.result()
+            except Exception as e:
+                failures.append([rows[k][location_type], repr(e)])
+        # Abandon stations whose retrieval has taken too long
+        now = time.monotonic()
+        for future, k in list(pending.items()):
+            if now - fetch_start_times.get(k, now) > timeout_s:
+                future.cancel()
+                del pending[future]
+                failures.append([rows[k][location_type], "timed out"])
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    fetched_ks = sorted(fetched)
+    dfs_weather = process_fetched_weather(
+        [fetched[k] for k in fetched_ks],
+        [rows[k] for k in fetched_ks],
+        keys_wanted,
+        weather_data_dir,
+        location_type,
+        time_colname,
+        get_hourly,
+    )
+    failures += [
+        [rows[k][location_type], repr(df_weather)]
+        for k, df_weather in zip(fetched_ks, dfs_weather)
+        if isinstance(df_weather, Exception)
+    ]
+    dfs_weather = [
+        df_weather
+        for df_weather in dfs_weather
+        if not isinstance(df_weather, Exception)
+    ]
+
+    df_failures = pd.DataFrame(failures, columns=[location_type, "error"])
+    if not df_failures.empty:
+        print(f"Could not get weather for {len(df_failures)} station(s)")
+    if dfs_weather:
+        dfs_weather = pd.concat(dfs_weather, ignore_index=True)
+    else:
+        dfs_weather = pd.DataFrame()
+    return [dfs_weather, df_failures]
+
+
+def get_station_catalogue(catalogue_filepath, max_age_days=30):
+    """
+    Get metadata of all meteostat weather stations, cached in a local file
+
+    The catalogue is only downloaded if catalogue_filepath does not exist or
+    is older than max_age_days, so it can otherwise be used offline.
+    """
+    if os.path.exists(catalogue_filepath):
+        modified = datetime.fromtimestamp(os.path.getmtime(catalogue_filepath))
+        if datetime.now() - modified <= timedelta(days=max_age_days):
+            return pd.read_parquet(catalogue_filepath)
+    df_catalogue = Stations().fetch().reset_index()
+    os.makedirs(os.path.dirname(catalogue_filepath) or ".", exist_ok=True)
+    df_catalogue.to_parquet(catalogue_filepath, index=False)
+    return df_catalogue
+
+
+class StationIndex(object):
+    """
+    Spatial index of weather stations, to look up stations nearest to points
+
+    Usage
+    -----
+    > index = StationIndex(get_station_catalogue("data/raw/stations.parquet"))
+    > df_nearest = index.query(
+          [50.1109, 48.8566], [8.6821, 2.3522], k=3, hourly_end_year=2020
+      )
+    """
+
+    def __init__(self, df_catalogue):
+        self.df_catalogue = df_catalogue.dropna(
+            subset=["latitude", "longitude"]
+        ).reset_index(drop=True)
+        self.coords = np.deg2rad(
+            self.df_catalogue[["latitude", "longitude"]].to_numpy()
+        )
+        self.station_countries = self.df_catalogue["country"].to_numpy()
+        self.station_names = self.df_catalogue["name"].to_numpy()
+        self.trees = {}
+
+    def get_tree(self, hourly_end_year=None):
+        """
+        Get positions (in the catalogue) of stations with hourly weather
+        through hourly_end_year, and spatial index of these stations (None if
+        there are none); indexes are cached by hourly_end_year
+        """
+        if hourly_end_year not in self.trees:
+            positions = np.arange(len(self.df_catalogue))
+            if hourly_end_year is not None:
+                positions = positions[
+                    (
+                        self.df_catalogue["hourly_end"].dt.year
+                        >= hourly_end_year
+                    ).to_numpy()
+                ]
+            tree = None
+            if len(positions):
+                tree = BallTree(self.coords[positions], metric="haversine")
+            self.trees[hourly_end_year] = (positions, tree)
+        return self.trees[hourly_end_year]
+
+    def get_matches(self, positions, country=None, name=None):
+        """Get mask of stations (positions) in country, named like name."""
+        matches = np.ones(len(positions), dtype=bool)
+        if country is not None:
+            matches &= self.station_countries[positions] == country
+        if name is not None:
+            matches[matches] = (
+                pd.Series(self.station_names[positions[matches]])
+                .str.contains(name, na=False)
+                .to_numpy(dtype=bool)
+            )
+        return matches
+
+    def _query_radius(self, positions, tree, points, radius, conditions):
+        indices, distances = tree.query_radius(
+            points,
+            r=radius / EARTH_RADIUS_M,
+            return_distance=True,
+            sort_results=True,
+        )
+        results = []
+        for point_indices, point_distances, (country, name) in zip(
+            indices, distances, conditions
+        ):
+            matches = self.get_matches(positions[point_indices], country, name)
+            results.append([point_indices[matches], point_distances[matches]])
+        return results
+
+    def _query_nearest(self, positions, tree, points, k, radius, conditions):
+        max_distance = np.inf if radius is None else radius / EARTH_RADIUS_M
+        results = [None] * len(points)
+        remaining = np.arange(len(points))
+        num_candidates = min(len(positions), 4 * k)
+        while len(remaining):
+            distances, indices = tree.query(
+                points[remaining], k=num_candidates
+            )
+            # Points without k matches (within radius) are queried again,
+            # with more stations
+            for p, point_indices, point_distances in zip(
+                remaining, indices, distances
+            ):
+                matches = self.get_matches(
+                    positions[point_indices], *conditions[p]
+                )
+                matches &= point_distances <= max_distance
+                if (
+                    matches.sum() >= k
+                    or point_distances[-1] > max_distance
+                    or num_candidates == len(positions)
+                ):
+                    results[p] = [
+                        point_indices[matches][:k],
+                        point_distances[matches][:k],
+                    ]
+            remaining = np.array(
+                [p for p in remaining if results[p] is None], dtype=int
+            )
+            num_candidates = min(len(positions), 2 * num_candidates)
+        return results
+
+    def _query_all(self, positions, points, conditions):
+        results = []
+        condition_indices = {}
+        for point, condition in zip(points, conditions):
+            if condition not in condition_indices:
+                condition_indices[condition] = np.flatnonzero(
+                    self.get_matches(positions, *condition)
+                )
+            point_indices = condition_indices[condition]
+            point_distances = haversine_distances(
+                point[None, :], self.coords[positions[point_indices]]
+            )[0]
+            order = np.argsort(point_distances, kind="stable")
+            results.append([point_indices[order], point_distances[order]])
+        return results
+
+    def query(
+        self,
+        lats,
+        lons,
+        k=1,
+        radius=None,
+        hourly_end_year=None,
+        countries=None,
+        names=None,
+    ):
+        """
+        Get k nearest stations to each of multiple points
+
+        Parameters
+        ----------
+        lats, lons : List
+            latitude and longitude of each (reference) point
+        k : int
+            maximum number of stations per point; all stations (that meet the
+            other conditions) are returned if None
+        radius : float
+            maximum distance (m) of stations from point
+        hourly_end_year : int
+            year through which stations must have hourly weather
+        countries : List
+            country per point, to which stations must belong (None for any)
+        names : List
+            pattern per point, which station names must contain (None for
+            any), same as .str.contains()
+        Returns
+        -------
+        df_nearest : pd.DataFrame
+            metadata of stations, with columns point (position of point in
+            inputs) and distance (m), sorted by point and distance
+        Notes
+        -----
+        1. Stations are filtered by hourly_end_year (the same for all points)
+           before they are indexed, with one (cached) index per year.
+        2. With k, all points are looked up in one query of the nearest
+           stations, and the query is repeated with more stations for points
+           where too few of these meet the conditions (within radius).
+           Without k, all points are looked up in one radius query of the
+           index or, without radius either, distances are calculated to all
+           stations that meet the conditions of each point.
+        3. Country and name conditions are only checked for the stations
+           found for each point.
+        """
+        points = np.deg2rad(np.column_stack([lats, lons]))
+        conditions = list(
+            zip(
+                countries or [None] * len(points),
+                names or [None] * len(points),
+            )
+        )
+        positions, tree = self.get_tree(hourly_end_year)
+        if tree is None:
+            results = [[np.empty(0, dtype=int), np.empty(0)]] * len(points)
+        elif k is not None:
+            results = self._query_nearest(
+                positions, tree, points, k, radius, conditions
+            )
+        elif radius is not None:
+            results = self._query_radius(
+                positions, tree, points, radius, conditions
+            )
+        else:
+            results = self._query_all(positions, points, conditions)
+
+        point_ids = np.repeat(
+            np.arange(len(points)), [len(r[0]) for r in results]
+        )
+        indices = np.concatenate(
+            [np.empty(0, dtype=int)] + [r[0] for r in results]
+        )
+        distances = np.concatenate([np.empty(0)] + [r[1] for r in results])
+        df_nearest = (
+            self.df_catalogue.iloc[positions[indices]]
+            .assign(point=point_ids, distance=distances * EARTH_RADIUS_M)
+            .reset_index(drop=True)
+        )
+        return df_nearest
+
+
 def get_airport_weather_station_metadata(
     station_lookup_ref_point_by_country_dict,
     station_cols_wanted,
     radius=None,
+    station_index=None,
+    hourly_end_year=2020,
 ):
-    dfs_stations = []
-    for k, v in station_lookup_ref_point_by_country_dict.items():
-        stations = Stations()
-        stations = stations.nearby(v[0], v[1], radius=radius)
-        station = stations.fetch()
-        station = station[station["country"] == k]
-        station = station[station["name"].str.contains(v[2])]
-        station = station[station["hourly_end"].dt.year >= 2020]
-        # display(station)
-        dfs_stations.append(station[station_cols_wanted])
-    df_stations = pd.concat(dfs_stations, ignore_index=True)
+    """
+    Get metadata of stations, by country, matching name near reference point
+
+    station_index is a StationIndex, eg. built from a local station
+    catalogue, so that all countries are looked up in one query; if not
+    specified, the index is built from the current meteostat catalogue.
+    """
+    if station_index is None:
+        station_index = StationIndex(Stations().fetch().reset_index())
+    countries = list(station_lookup_ref_point_by_country_dict)
+    ref_points = list(station_lookup_ref_point_by_country_dict.values())
+    df_stations = station_index.query(
+        [v[0] for v in ref_points],
+        [v[1] for v in ref_points],
+        k=None,
+        radius=radius,
+        hourly_end_year=hourly_end_year,
+        countries=countries,
+        names=[v[2] for v in ref_points],
+    )
+    df_stations = df_stations[station_cols_wanted]
     df_stations = df_stations.rename(columns={"name": "from_station_name"})
     df_stations["from_station_name"] = df_stations[
         "from_station_name"
     ].str.replace(" / ", "_")
     return df_stations
+
+
+def get_weighted_country_weather(
+    df_weather,
+    df_weights,
+    value_cols=["temp", "rhum"],
+    location_type="from_station_name",
+    time_colname="startdatehour",
+    weight_colname="weight",
+    min_coverage=0,
+):
+    """
+    Get weighted average of weather over multiple stations per country, hour
+
+    Parameters
+    ----------
+    df_weather : pd.DataFrame
+        weather for all stations, with columns location_type (station),
+        time_colname and value_cols
+    df_weights : pd.DataFrame
+        weight of each station in each country, with columns location_type,
+        country and weight_colname (eg. population near the station, or
+        share of the country's load); a station may have weights in
+        multiple countries
+    value_cols : List
+        weather columns to be averaged
+    min_coverage : float
+        minimum fraction of the country's total weight for which weather
+        must be available at an hour, below which the average is missing
+    Returns
+    -------
+    df_country_weather : pd.DataFrame
+        weighted average weather, with columns country, time_colname and
+        value_cols
+    Notes
+    -----
+    1. Averages are calculated for all countries and hours at once, as
+       products of (hour x station) weather and (station x country) sparse
+       weight matrices.
+    2. If weather is missing for some of a country's stations at an hour,
+       the weights of the remaining stations are renormalized to sum to 1.
+    """
+    stations = pd.Index(df_weights[location_type].unique())
+    # Map stations via their unique values, rather than row by row
+    codes, uniques = pd.factorize(df_weather[location_type])
+    station_codes = stations.get_indexer(uniques)[codes]
+    if (station_codes < 0).any():
+        df_weather = df_weather[station_codes >= 0]
+        station_codes = station_codes[station_codes >= 0]
+    hour_codes, hours = pd.factorize(df_weather[time_colname], sort=True)
+    # position of each row in (hour x station) grid
+    grid_positions = hour_codes * len(stations) + station_codes
+    country_codes, countries = pd.factorize(df_weights["country"], sort=True)
+    # (station x country) weights
+    weights = sparse.csr_matrix(
+        (
+            df_weights[weight_colname].to_numpy(dtype=float),
+            (stations.get_indexer(df_weights[location_type]), country_codes),
+        ),
+        shape=(len(stations), len(countries)),
+    )
+    total_weights = np.asarray(weights.sum(axis=0)).ravel()
+
+    df_country_weather = pd.DataFrame(
+        {
+            "country": np.tile(countries, len(hours)),
+            time_colname: np.repeat(hours, len(countries)),
+        }
+    )
+    for col in value_cols:
+        # (hour x station) weather, and whether it is available
+        values = np.zeros((len(hours), len(stations)))
+        available = np.zeros((len(hours), len(stations)), dtype=bool)
+        col_values = df_weather[col].to_numpy(dtype=float)
+        col_available = ~np.isnan(col_values)
+        np.put(values, grid_positions, np.where(col_available, col_values, 0))
+        np.put(available, grid_positions, col_available)
+        weighted_sums = values @ weights
+        available_weights = available.astype(float) @ weights
+        with np.errstate(invalid="ignore", divide="ignore"):
+            averages = weighted_sums / available_weights
+        averages[
+            (available_weights == 0)
+            | (available_weights < min_coverage * total_weights)
+        ] = np.nan
+        df_country_weather[col] = averages.ravel()
+    return df_country_weather